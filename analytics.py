@@ -0,0 +1,107 @@
+"""
+Анализ заданий тестирования: трудность, дискриминативность, решаемость по
+номерам ЕГЭ и распределение баллов.
+
+Считается векторно по матрице «ученики × задачи». NumPy необязателен:
+без него анализ недоступен (AVAILABLE = False).
+"""
+try:
+    import numpy as np
+except ImportError:  # numpy не установлен — анализ заданий отключён
+    np = None
+
+AVAILABLE = np is not None
+
+
+def _round(value, digits=3):
+    """float или None (NaN/inf — показатель не определён)."""
+    value = float(value)
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    return round(value, digits)
+
+
+def build_matrix(rows):
+    """Матрица из строк (student_id, task_id, ege_number, correct).
+
+    Возвращает (student_ids, task_ids, ege_numbers, matrix): matrix[i, j] — 1/0,
+    NaN — задача j не входила в вариант ученика i.
+    """
+    student_ids = sorted({row[0] for row in rows})
+    task_ege = {}
+    for _, task_id, ege_number, _ in rows:
+        task_ege.setdefault(task_id, ege_number)
+    task_ids = sorted(task_ege, key=lambda t: (task_ege[t] is None, task_ege[t] or 0, t))
+    s_index = {sid: i for i, sid in enumerate(student_ids)}
+    t_index = {tid: j for j, tid in enumerate(task_ids)}
+
+    matrix = np.full((len(student_ids), len(task_ids)), np.nan)
+    if rows:
+        data = np.array([(s_index[r[0]], t_index[r[1]], 1.0 if r[3] else 0.0) for r in rows])
+        matrix[data[:, 0].astype(int), data[:, 1].astype(int)] = data[:, 2]
+    return student_ids, task_ids, [task_ege[t] for t in task_ids], matrix
+
+
+def item_analysis(rows):
+    """Показатели по строкам (student_id, task_id, ege_number, correct).
+
+    p_value — доля решивших задачу среди тех, кому она досталась;
+    discrimination — точечно-бисериальная корреляция решения задачи с баллом
+    за остальные задачи (без самой задачи, чтобы не завышать связь).
+    """
+    student_ids, task_ids, ege_numbers, matrix = build_matrix(rows)
+    assigned = ~np.isnan(matrix)
+    scores = np.where(assigned, matrix, 0.0)
+    totals = scores.sum(axis=1)
+    attempts = assigned.sum(axis=0)
+    solved = scores.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_values = solved / attempts
+
+        # Балл за остальные задачи; все средние — только по ученикам, которым задача досталась
+        rest = totals[:, None] - scores
+        mean_x = p_values
+        mean_rest = np.where(assigned, rest, 0.0).sum(axis=0) / attempts
+        dx = np.where(assigned, scores - mean_x, 0.0)
+        drest = np.where(assigned, rest - mean_rest, 0.0)
+        cov = (dx * drest).sum(axis=0) / attempts
+        var_x = (dx ** 2).sum(axis=0) / attempts
+        var_rest = (drest ** 2).sum(axis=0) / attempts
+        discrimination = cov / np.sqrt(var_x * var_rest)
+
+    tasks = [{
+        'task_id': task_id,
+        'ege_number': ege_numbers[j],
+        'attempts': int(attempts[j]),
+        'solved': int(solved[j]),
+        'p_value': _round(p_values[j]),
+        'discrimination': _round(discrimination[j]),
+    } for j, task_id in enumerate(task_ids)]
+
+    by_ege = []
+    if task_ids:
+        keys = np.array([-1 if e is None else e for e in ege_numbers])
+        numbers, inverse = np.unique(keys, return_inverse=True)
+        ege_solved = np.bincount(inverse, weights=solved, minlength=len(numbers))
+        ege_attempts = np.bincount(inverse, weights=attempts, minlength=len(numbers))
+        ege_tasks = np.bincount(inverse, minlength=len(numbers))
+        for k, number in enumerate(numbers):
+            by_ege.append({
+                'ege_number': None if number == -1 else int(number),
+                'tasks': int(ege_tasks[k]),
+                'attempts': int(ege_attempts[k]),
+                'solve_rate': _round(ege_solved[k] / ege_attempts[k]) if ege_attempts[k] else None,
+            })
+
+    max_score = int(assigned.sum(axis=1).max()) if student_ids else 0
+    distribution = np.bincount(totals.astype(int), minlength=max_score + 1) if student_ids else np.zeros(1, int)
+    summary = {
+        'students': len(student_ids),
+        'max_score': max_score,
+        'mean': _round(totals.mean(), 2) if student_ids else None,
+        'median': _round(np.median(totals), 2) if student_ids else None,
+        'std': _round(totals.std(), 2) if student_ids else None,
+        'distribution': [{'score': score, 'count': int(count)} for score, count in enumerate(distribution)],
+    }
+    return {'summary': summary, 'tasks': tasks, 'ege_numbers': by_ege}
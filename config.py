@@ -12,6 +12,36 @@ IMAGES_DIR = os.path.join(DATA_DIR, 'images')
 ATTACHMENTS_DIR = os.path.join(DATA_DIR, 'attachments')
 STUDENT_UPLOADS_DIR = os.path.join(DATA_DIR, 'student_uploads')
 EXPORTS_DIR = os.path.join(BASE_DIR, 'exports')
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+
+# Пул соединений SQLite: сколько простаивающих соединений держать открытыми
+DB_POOL_SIZE = int(os.environ.get('EGE_DB_POOL_SIZE', '8'))
+
+# Групповая фиксация записей: поток-писатель собирает запросы за окно (мс) в одну транзакцию
+WRITE_BATCH_WINDOW_MS = 3
+WRITE_BATCH_MAX = 64
+# Сколько секунд запрос ждёт свою запись, прежде чем ответить ошибкой
+WRITE_TIMEOUT_SECONDS = 30
+
+# Отметки присутствия учеников копятся в памяти и пишутся в БД пачкой раз в N секунд
+PRESENCE_FLUSH_SECONDS = 5
+# Пинг не обновляет отметку, если она моложе N секунд
+PRESENCE_TOUCH_FRESH_SECONDS = 10
+
+# Сколько вариантов держать в кэше состава задач (LRU)
+VARIANT_CACHE_SIZE = 256
+
+# Сколько ответов принимает одно пакетное автосохранение
+SAVE_BATCH_MAX_ITEMS = 100
+# Сколько последних ревизий ответов (ученик, задача) помнить в памяти (LRU)
+ANSWER_REV_CACHE_SIZE = 20000
+# Перепроверка ответов после смены ключа: строк на один executemany
+REGRADE_BATCH_SIZE = 500
+# Сколько анализов заданий завершённых тестирований держать в памяти (LRU)
+ANALYTICS_CACHE_SIZE = 32
+
+# Поток событий /test/events: как часто слать keepalive (он же отметка присутствия), сек
+SSE_KEEPALIVE_SECONDS = 15
 
 # Настройки сервера
 HOST = '0.0.0.0'  # Доступ из локальной сети
@@ -34,6 +64,9 @@ ALLOWED_STUDENT_UPLOAD_EXTENSIONS = {'ods', 'odt'}
 ALLOWED_IMAGE_EXTENSIONS = {'png'}
 ALLOWED_ATTACHMENT_EXTENSIONS = {'txt', 'xlsx', 'xls', 'ods', 'csv'}
 
+# Ширины уменьшенных копий изображений задач (первая — миниатюра в списках)
+IMAGE_VARIANT_WIDTHS = (320, 800, 1280)
+
 # Количество ответов по умолчанию для номеров ЕГЭ
 DEFAULT_ANSWER_COUNT = {
     **{i: 1 for i in range(1, 17)},   # 1-16: один ответ
@@ -0,0 +1,155 @@
+"""
+Проверка ответов учеников по ключу задачи.
+
+Ключ (answer_count, answer_1, answer_2, answer_text) компилируется один раз
+в объект-сравниватель: эталонные значения уже нормализованы, числа разобраны,
+строки приведены к casefold. При сохранении ответа остаётся нормализовать
+только ответ ученика.
+"""
+
+
+def norm_atom(value):
+    """Одно поле ответа: обрезка и сжатие пробелов; пустое — None."""
+    if value is None:
+        return None
+    s = str(value).strip()
+    if s == '':
+        return None
+    # Сжимаем пробелы внутри (часто вводят случайные пробелы)
+    return ' '.join(s.split())
+
+
+def is_int_like(s):
+    if s is None:
+        return False
+    if s.startswith(('+', '-')):
+        return s[1:].isdigit() and len(s) > 1
+    return s.isdigit()
+
+
+def norm_text(value):
+    """Многострочный ответ: пустые строки убраны, пробелы в строках сжаты."""
+    return '\n'.join(' '.join(line.strip().split())
+                     for line in str(value).strip().splitlines() if line.strip() != '')
+
+
+def _lines(value):
+    return [line.strip() for line in str(value or '').splitlines()]
+
+
+class MissingKey:
+    """Эталон поля не задан: любой ответ неверен."""
+    __slots__ = ()
+
+    def matches(self, provided):
+        return False
+
+
+class IntKey:
+    """Эталон — целое число; ответ-число сравнивается как число, иначе как строка."""
+    __slots__ = ('value', 'folded')
+
+    def __init__(self, value, folded):
+        self.value = value
+        self.folded = folded
+
+    def matches(self, provided):
+        a = norm_atom(provided)
+        if a is None:
+            return False
+        if is_int_like(a):
+            try:
+                return int(a) == self.value
+            except ValueError:
+                pass
+        return a.casefold() == self.folded
+
+
+class StrKey:
+    """Эталон — строка: регистронезависимое сравнение (работает и для кириллицы)."""
+    __slots__ = ('folded',)
+
+    def __init__(self, folded):
+        self.folded = folded
+
+    def matches(self, provided):
+        a = norm_atom(provided)
+        return a is not None and a.casefold() == self.folded
+
+
+def compile_atom(value):
+    b = norm_atom(value)
+    if b is None:
+        return MissingKey()
+    if is_int_like(b):
+        try:
+            return IntKey(int(b), b.casefold())
+        except ValueError:
+            # Например, надстрочные цифры: isdigit() истинно, но int() их не разбирает
+            pass
+    return StrKey(b.casefold())
+
+
+class Unchecked:
+    """Ответ не проверяется автоматически (нет задачи или эталона текста)."""
+    __slots__ = ()
+
+    def grade(self, answer_1=None, answer_2=None, answer_text=None):
+        return None
+
+
+class TextMatcher:
+    """Многострочный ответ (задачи 25/27 и т. п.) с эталоном в answer_text."""
+    __slots__ = ('expected',)
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def grade(self, answer_1=None, answer_2=None, answer_text=None):
+        return norm_text(answer_text or '') == self.expected
+
+
+class FieldsMatcher:
+    """N полей: answer_1, answer_2, затем строки answer_text по одной на поле."""
+    __slots__ = ('atoms',)
+
+    def __init__(self, atoms):
+        self.atoms = tuple(atoms)
+
+    def grade(self, answer_1=None, answer_2=None, answer_text=None):
+        atoms = self.atoms
+        provided = [answer_1, answer_2]
+        if len(atoms) > 2:
+            extra = _lines(answer_text)
+            provided.extend(extra[idx] if idx < len(extra) else None for idx in range(len(atoms) - 2))
+        return all(atom.matches(p) for atom, p in zip(atoms, provided))
+
+
+UNCHECKED = Unchecked()
+
+
+def compile_key(task):
+    """Сравниватель для строки tasks (нужны answer_count, answer_1, answer_2, answer_text)."""
+    if not task:
+        return UNCHECKED
+    count = task['answer_count']
+    if count == 0:
+        # Текстовый ответ без эталона проверяется вручную
+        correct_text = task['answer_text']
+        if correct_text is None or str(correct_text).strip() == '':
+            return UNCHECKED
+        return TextMatcher(norm_text(correct_text))
+    if count == 1:
+        return FieldsMatcher([compile_atom(task['answer_1'])])
+    if count == 2:
+        return FieldsMatcher([compile_atom(task['answer_1']), compile_atom(task['answer_2'])])
+    count = int(count)
+    expected = [task['answer_1'], task['answer_2']]
+    extra = _lines(task['answer_text'])
+    expected.extend(extra[idx - 2] if idx - 2 < len(extra) else None for idx in range(2, count))
+    return FieldsMatcher([compile_atom(expected[i]) for i in range(count)])
+
+
+def grade(task, answer_1=None, answer_2=None, answer_text=None):
+    """True/False — верно ли; None — не проверяется автоматически."""
+    return compile_key(task).grade(answer_1, answer_2, answer_text)
@@ -0,0 +1,173 @@
+"""
+Обработка изображений задач: сжатие PNG, уменьшенные копии и размеры.
+
+Pillow необязателен. Без него сохраняются только размеры из заголовка PNG,
+а вместо уменьшенных копий отдаётся оригинал.
+"""
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен — работаем без уменьшенных копий
+    Image = None
+
+from config import IMAGE_VARIANT_WIDTHS
+
+AVAILABLE = Image is not None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _webp_supported():
+    try:
+        from PIL import features
+        return bool(features.check('webp'))
+    except Exception:
+        return False
+
+
+# Уменьшенные копии — WebP без потерь (текст на скриншотах остаётся чётким), иначе PNG
+VARIANT_EXT = 'webp' if AVAILABLE and _webp_supported() else 'png'
+
+
+def png_size(path):
+    """(ширина, высота) из заголовка PNG или None."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+    except OSError:
+        return None
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def variant_name(filename, width):
+    """Имя уменьшенной копии: <имя>_w<ширина>.webp рядом с оригиналом."""
+    stem = os.path.splitext(filename)[0]
+    return f'{stem}_w{width}.{VARIANT_EXT}'
+
+
+def _temp_path(path):
+    """Уникальный временный файл рядом с path (параллельные запросы не пишут в один файл)."""
+    directory, filename = os.path.split(path)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=filename + '.', suffix='.tmp',
+                                     delete=False) as f:
+        return f.name
+
+
+def _replace_atomically(path, save):
+    tmp = _temp_path(path)
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _recompress_png(path, img):
+    """Пересжать PNG без потерь; файл заменяется, только если стал меньше."""
+    tmp = _temp_path(path)
+    try:
+        img.save(tmp, 'PNG', optimize=True)
+        if os.path.getsize(tmp) < os.path.getsize(path):
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+_locks_guard = threading.Lock()
+_variant_locks = {}
+
+
+def _variant_lock(target):
+    """Блокировка на файл копии: одну копию строит только один поток."""
+    with _locks_guard:
+        lock = _variant_locks.get(target)
+        if lock is None:
+            lock = _variant_locks[target] = threading.Lock()
+        return lock
+
+
+def _make_variant(path, img, width):
+    if img.width <= width:
+        return None
+    target = os.path.join(os.path.dirname(path), variant_name(os.path.basename(path), width))
+    height = max(1, round(img.height * width / img.width))
+    resized = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+    resized = resized.resize((width, height), Image.LANCZOS)
+    if VARIANT_EXT == 'webp':
+        _replace_atomically(target, lambda p: resized.save(p, 'WEBP', lossless=True, method=6))
+    else:
+        _replace_atomically(target, lambda p: resized.save(p, 'PNG', optimize=True))
+    return target
+
+
+def ingest(path):
+    """Обработать только что сохранённое изображение задачи.
+
+    Пересжимает PNG, строит копии для IMAGE_VARIANT_WIDTHS и возвращает
+    (ширина, высота); (None, None), если размер определить не удалось.
+    """
+    size = png_size(path)
+    if AVAILABLE:
+        try:
+            with Image.open(path) as img:
+                img.load()
+                size = img.size
+                if img.format == 'PNG':
+                    _recompress_png(path, img)
+                for width in IMAGE_VARIANT_WIDTHS:
+                    _make_variant(path, img, width)
+        except Exception:
+            # Повреждённый или слишком большой файл — оставляем как есть
+            pass
+    return size or (None, None)
+
+
+def dimensions(path):
+    """(ширина, высота) уже обработанного изображения без его изменения."""
+    size = png_size(path)
+    if size is None and AVAILABLE:
+        try:
+            with Image.open(path) as img:
+                size = img.size
+        except Exception:
+            size = None
+    return size or (None, None)
+
+
+def variant_path(path, width):
+    """Путь к копии шириной width; строит её при первом запросе (для старых задач).
+
+    None — копии нет и построить её нельзя (нет Pillow или картинка не шире width).
+    """
+    target = os.path.join(os.path.dirname(path), variant_name(os.path.basename(path), width))
+    if os.path.exists(target):
+        return target
+    if not AVAILABLE or width not in IMAGE_VARIANT_WIDTHS or not os.path.exists(path):
+        return None
+    with _variant_lock(target):
+        # Пока ждали блокировку, копию мог построить соседний запрос
+        if os.path.exists(target):
+            return target
+        try:
+            with Image.open(path) as img:
+                img.load()
+                return _make_variant(path, img, width)
+        except Exception:
+            return None
+
+
+def delete(path):
+    """Удалить изображение вместе со всеми его копиями."""
+    directory, filename = os.path.split(path)
+    for name in [filename] + [variant_name(filename, w) for w in IMAGE_VARIANT_WIDTHS]:
+        target = os.path.join(directory, name)
+        if os.path.exists(target):
+            os.remove(target)
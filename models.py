@@ -1,32 +1,597 @@
 """
 Модели базы данных SQLite
 """
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import pathlib
+import queue
 import sqlite3
+import sys
+import threading
+import time
 from datetime import datetime, timezone
-from config import DATABASE_PATH
+from config import (DATABASE_PATH, DB_POOL_SIZE, IMAGES_DIR, PRESENCE_FLUSH_SECONDS, VARIANT_CACHE_SIZE,
+                    ANSWER_REV_CACHE_SIZE, REGRADE_BATCH_SIZE, WRITE_BATCH_WINDOW_MS, WRITE_BATCH_MAX,
+                    WRITE_TIMEOUT_SECONDS, ANALYTICS_CACHE_SIZE)
+import analytics
+import grading
+import images
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает."""
+    pool = None
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def close_physically(self):
+        super().close()
+
+
+class ConnectionPool:
+    """Пул соединений SQLite.
+
+    Праги применяются один раз при открытии соединения. Внутри HTTP-запроса
+    (между begin_request и end_request) все вызовы get_db() в потоке получают
+    одно и то же соединение, поэтому модели делят его без повторных connect().
+    """
+
+    def __init__(self, database, size, readonly=False):
+        self.database = database
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=max(1, size))
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.readonly:
+            return self._connect_readonly()
+        # timeout помогает избежать 'database is locked' при частых автосохранениях
+        conn = sqlite3.connect(self.database, timeout=10, check_same_thread=False,
+                               factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+
+        # Праги для устойчивой работы в кабинете (много чтений + частые записи)
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.pool = self
+        return conn
+
+    def _connect_readonly(self):
+        uri = pathlib.Path(self.database).resolve().as_uri() + '?mode=ro'
+        try:
+            conn = sqlite3.connect(uri, uri=True, timeout=10, check_same_thread=False,
+                                   factory=PooledConnection)
+            conn.execute('SELECT 1 FROM sqlite_master LIMIT 1')
+        except sqlite3.OperationalError:
+            # Без файлов -wal/-shm WAL-базу нельзя открыть в mode=ro — берём обычное соединение
+            conn = sqlite3.connect(self.database, timeout=10, check_same_thread=False,
+                                   factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA query_only = 1')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.pool = self
+        return conn
+
+    def current(self):
+        """Соединение, закреплённое за текущим потоком (или None)."""
+        return getattr(self._local, 'conn', None)
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        if getattr(self._local, 'in_request', False):
+            self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        # Соединение запроса остаётся за потоком до end_request()
+        if getattr(self._local, 'conn', None) is conn:
+            return
+        self._put_back(conn)
+
+    def _put_back(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close_physically()
+        except sqlite3.Error:
+            try:
+                conn.close_physically()
+            except sqlite3.Error:
+                pass
+
+    def begin_request(self):
+        self._local.in_request = True
+
+    def end_request(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        self._local.in_request = False
+        if conn is not None:
+            self._put_back(conn)
+
+
+_pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE)
+
 
 def get_db():
     """Получить соединение с БД (с настройками для многопоточного Flask)"""
-    # timeout помогает избежать 'database is locked' при частых автосохранениях
-    conn = sqlite3.connect(DATABASE_PATH, timeout=10, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    return _pool.acquire()
 
-    # Праги для устойчивой работы в кабинете (много чтений + частые записи)
-    conn.execute('PRAGMA foreign_keys = ON')
-    conn.execute('PRAGMA journal_mode = WAL')
-    conn.execute('PRAGMA synchronous = NORMAL')
-    conn.execute('PRAGMA busy_timeout = 5000')
-    return conn
+
+def begin_request_db():
+    """Закрепить одно соединение из пула за текущим запросом."""
+    _pool.begin_request()
+
+
+def end_request_db():
+    """Вернуть соединение запроса в пул."""
+    _pool.end_request()
+
+
+# Отдельный пул соединений только для чтения (отчёты учителя)
+_read_pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE, readonly=True)
+
+
+@contextlib.contextmanager
+def read_snapshot():
+    """Согласованный снимок БД для длинных отчётов учителя.
+
+    Внутри блока все читающие методы моделей используют одно read-only
+    соединение с открытой транзакцией чтения: автосохранения учеников
+    продолжают фиксироваться, а отчёт видит состояние на момент входа.
+    """
+    if _read_pool.current() is not None:
+        yield _read_pool.current()
+        return
+    _read_pool.begin_request()
+    try:
+        conn = _read_pool.acquire()
+        conn.execute('BEGIN')
+        # Первое чтение фиксирует снимок WAL для всей транзакции
+        conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()
+        yield conn
+    finally:
+        _read_pool.end_request()
+
+
+def _read_db():
+    """Соединение для чтения: снимок отчёта, если он открыт, иначе обычное."""
+    conn = _read_pool.current()
+    if conn is not None:
+        return conn
+    return get_db()
+
+
+class WriteTimeout(sqlite3.OperationalError):
+    """Поток-писатель не выполнил запись за отведённое время."""
+
+
+class WriteQueue:
+    """Единственный поток-писатель с групповой фиксацией (group commit).
+
+    Запросы передают функцию fn(cursor, *args) и ждут Future с её результатом.
+    Поток собирает всё, что пришло за окно в несколько миллисекунд, выполняет
+    каждую функцию в своём SAVEPOINT и фиксирует пачку одним COMMIT. Ошибка
+    одной функции откатывает только её и возвращается вызвавшему её запросу.
+    Если БД недоступна, поток не падает: ожидающие запросы получают ошибку,
+    а соединение открывается заново с нарастающей паузой.
+    """
+
+    RETRY_MIN_SECONDS = 0.1
+    RETRY_MAX_SECONDS = 5
+
+    def __init__(self, database, window_ms, max_batch, timeout):
+        self.database = database
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.timeout = timeout
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+        self._jobs.put((fn, args, future))
+        return future
+
+    def call(self, fn, *args):
+        """Выполнить fn(cursor, *args) в потоке-писателе и дождаться результата.
+
+        Не дождавшись за timeout секунд, снимает запись из очереди и бросает
+        WriteTimeout; уже начатая запись при этом может успеть зафиксироваться.
+        """
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise WriteTimeout(f'Запись в БД не выполнена за {self.timeout} с') from None
+
+    def _connect(self):
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE ... COMMIT)
+        conn = sqlite3.connect(self.database, timeout=10, check_same_thread=False,
+                               isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+
+    def _next_batch(self):
+        batch = [self._jobs.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._jobs.get(timeout=timeout))
+                else:
+                    batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        jobs = []
+        while True:
+            try:
+                jobs.append(self._jobs.get_nowait())
+            except queue.Empty:
+                return jobs
+
+    @staticmethod
+    def _fail(jobs, exc):
+        for _, _, future in jobs:
+            try:
+                if not future.done():
+                    future.set_exception(exc)
+            except concurrent.futures.InvalidStateError:
+                pass  # запрос успел отменить запись по таймауту
+
+    @staticmethod
+    def _rollback(conn):
+        """Откатить незавершённую транзакцию; False — соединение негодно."""
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            return True
+        except sqlite3.Error:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return False
+
+    def _run(self):
+        conn = None
+        delay = self.RETRY_MIN_SECONDS
+        while True:
+            batch = self._next_batch()
+            try:
+                if conn is None:
+                    conn = self._connect()
+                self._commit_batch(conn, batch)
+            except Exception as exc:
+                self._fail(batch, exc)
+                if conn is not None and not self._rollback(conn):
+                    conn = None
+                if conn is None:
+                    # БД недоступна: не держим очередь до таймаута и ждём перед новой попыткой
+                    logger.warning('Поток записи: нет соединения с БД, повтор через %.1f с: %s', delay, exc)
+                    self._fail(self._drain(), exc)
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.RETRY_MAX_SECONDS)
+                    continue
+            delay = self.RETRY_MIN_SECONDS
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.cursor()
+        for fn, args, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            cursor.execute('SAVEPOINT job')
+            try:
+                result = fn(cursor, *args)
+            except Exception as exc:
+                cursor.execute('ROLLBACK TO job')
+                cursor.execute('RELEASE job')
+                outcomes.append((future, None, exc))
+            else:
+                cursor.execute('RELEASE job')
+                outcomes.append((future, result, None))
+        conn.execute('COMMIT')
+        for future, result, exc in outcomes:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+_writer = WriteQueue(DATABASE_PATH, WRITE_BATCH_WINDOW_MS, WRITE_BATCH_MAX, WRITE_TIMEOUT_SECONDS)
+
+
+def _utc_now_str():
+    """Текущее время UTC в формате CURRENT_TIMESTAMP SQLite."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PresenceBuffer:
+    """Отметки присутствия учеников с отложенной записью (write-behind).
+
+    touch() только запоминает время в памяти; фоновый поток раз в interval
+    секунд пишет накопленные отметки в students.last_seen_at одной транзакцией.
+    """
+
+    # Сколько секунд держать в памяти уже записанную отметку
+    RETAIN_SECONDS = 600
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._touched = {}
+        self._dirty = set()
+        self._thread = None
+
+    def touch(self, student_id, fresh_seconds=0):
+        """Отметить ученика; если отметка моложе fresh_seconds — ничего не делать."""
+        now = time.monotonic()
+        with self._lock:
+            if fresh_seconds and now - self._touched.get(student_id, float('-inf')) < fresh_seconds:
+                return
+            self._touched[student_id] = now
+            self._last_seen[student_id] = _utc_now_str()
+            self._dirty.add(student_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='presence-flusher', daemon=True)
+                self._thread.start()
+
+    def get(self, student_id):
+        with self._lock:
+            return self._last_seen.get(student_id)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return 0
+            rows = [(self._last_seen[sid], sid) for sid in self._dirty]
+            self._dirty.clear()
+        try:
+            _writer.call(_write_last_seen, rows)
+        except Exception:
+            with self._lock:
+                self._dirty.update(sid for _, sid in rows)
+            raise
+        self._prune()
+        return len(rows)
+
+    def _prune(self):
+        cutoff = datetime.now(timezone.utc).timestamp() - self.RETAIN_SECONDS
+        cutoff_str = datetime.fromtimestamp(cutoff, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            stale = [sid for sid, seen in self._last_seen.items()
+                     if seen < cutoff_str and sid not in self._dirty]
+            for sid in stale:
+                del self._last_seen[sid]
+                self._touched.pop(sid, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # БД временно занята — отметки останутся в буфере до следующего раза
+                pass
+            except Exception:
+                # Любая другая ошибка не должна останавливать поток записи
+                logger.exception('Не удалось записать отметки присутствия')
+
+
+def _write_last_seen(cursor, rows):
+    cursor.executemany('UPDATE students SET last_seen_at = ? WHERE id = ?', rows)
+
+
+def _flush_presence_on_exit():
+    try:
+        _presence.flush()
+    except Exception:
+        pass
+
+
+_presence = PresenceBuffer(PRESENCE_FLUSH_SECONDS)
+atexit.register(_flush_presence_on_exit)
+
+
+class VersionedCache:
+    """Кэш результатов чтения в памяти процесса со счётчиком версий (LRU).
+
+    Данные меняются только методами моделей; после каждой такой записи
+    кэш сбрасывается и версия растёт. Читатель запоминает версию до запроса
+    к БД и кладёт результат в кэш, только если за это время версия не
+    изменилась, поэтому устаревшее состояние не может попасть в кэш.
+    Значения хранятся как есть — вызывающий отдаёт наружу копии.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._version = 0
+        self._items = collections.OrderedDict()
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, key, loader):
+        # Отчёты внутри read_snapshot() читают из снимка, мимо кэша
+        if _read_pool.current() is not None:
+            return loader()
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            version = self._version
+        value = loader()
+        with self._lock:
+            if self._version == version:
+                self._items[key] = value
+                if self.maxsize is not None and len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+        return value
+
+    def get_many(self, keys, loader):
+        """{ключ: значение} для keys; loader(недостающие ключи) -> dict, одним запросом.
+
+        Ключей, которых нет в ответе loader, нет и в результате (и в кэше).
+        """
+        keys = list(keys)
+        if _read_pool.current() is not None:
+            return loader(keys) if keys else {}
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    found[key] = self._items[key]
+            version = self._version
+        missing = [key for key in keys if key not in found]
+        if not missing:
+            return found
+        loaded = loader(missing)
+        with self._lock:
+            if self._version == version:
+                self._items.update(loaded)
+                while self.maxsize is not None and len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+        found.update(loaded)
+        return found
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._items.clear()
+
+    @contextlib.contextmanager
+    def mutation(self):
+        try:
+            yield
+        finally:
+            self.invalidate()
+
+
+class SessionEvents:
+    """Счётчики изменений сессий для ожидающих SSE-потоков учеников.
+
+    Методы TestSession увеличивают счётчик сессии после фиксации записи,
+    потоки /test/events ждут на условии, пока счётчик не сдвинется.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = {}
+
+    def current(self, session_id):
+        with self._cond:
+            return self._seq.get(session_id, 0)
+
+    def notify(self, session_id):
+        with self._cond:
+            self._seq[session_id] = self._seq.get(session_id, 0) + 1
+            self._cond.notify_all()
+
+    def wait(self, session_id, seen, timeout):
+        """Ждать изменения после seen не дольше timeout секунд; вернуть текущий номер."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq.get(session_id, 0) != seen, timeout)
+            return self._seq.get(session_id, 0)
+
+
+class AnswerRevisions:
+    """Наибольшая записанная ревизия ответа по (student_id, task_id), LRU.
+
+    Ревизию присылает клиент, она растёт с каждым изменением ответа. Повтор или
+    опоздавший старый запрос отсекается здесь без транзакции записи; если
+    запись вытеснена или сервер перезапущен, то же условие проверяет upsert в БД.
+    """
+
+    def __init__(self, maxsize):
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._revs = collections.OrderedDict()
+
+    def is_stale(self, student_id, task_id, rev):
+        if not rev:
+            return False
+        with self._lock:
+            known = self._revs.get((student_id, task_id))
+        return known is not None and rev <= known
+
+    def record(self, student_id, task_id, rev):
+        if not rev:
+            return
+        key = (student_id, task_id)
+        with self._lock:
+            if rev > self._revs.get(key, 0):
+                self._revs[key] = rev
+            self._revs.move_to_end(key)
+            while len(self._revs) > self._maxsize:
+                self._revs.popitem(last=False)
+
+
+_session_events = SessionEvents()
+_answer_revs = AnswerRevisions(ANSWER_REV_CACHE_SIZE)
+
+# Строки test_sessions по id и текущая активная сессия
+_sessions = VersionedCache()
+_ACTIVE_SESSION = 'active'
+# Состав вариантов: (кортеж задач, frozenset id задач) по variant_id
+_variant_tasks = VersionedCache(VARIANT_CACHE_SIZE)
+# Версия состава учеников: растёт при каждом удалении учеников (значений не хранит)
+_roster = VersionedCache()
+# Скомпилированные ключи ответов (grading) по task_id
+_matchers = VersionedCache()
+# Общие критерии оценки {total_tasks: пороги} (один ключ)
+_criteria = VersionedCache()
+# Анализ заданий по session_id — только для закрытых сессий
+_analytics = VersionedCache(ANALYTICS_CACHE_SIZE)
+# Поля tasks, из которых собирается ключ ответа
+ANSWER_KEY_FIELDS = frozenset({'answer_count', 'answer_1', 'answer_2', 'answer_text'})
 
 def _table_has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
     cur = conn.cursor()
     cur.execute(f"PRAGMA table_info({table})")
     return any(row[1] == column for row in cur.fetchall())
 
-def migrate_db():
-    """Миграции схемы БД для уже существующих установок."""
-    conn = get_db()
-    cur = conn.cursor()
+def _migrate_legacy_schema(conn, cur):
+    """Старые установки: починка внешних ключей, типы вариантов, недостающие колонки."""
 
     def _fk_refs(table: str):
         try:
@@ -144,16 +709,7 @@ def migrate_db():
     # 0) Repair broken FKs to variants_old from older migrations
     fk_tables = ('variant_tasks', 'test_sessions', 'students')
     if any(any(r[2] == 'variants_old' for r in _fk_refs(t)) for t in fk_tables):
-        conn.execute('PRAGMA foreign_keys = OFF')
-        conn.execute('BEGIN')
-        try:
-            _rebuild_variant_dependent_tables()
-            conn.execute('COMMIT')
-        except Exception:
-            conn.execute('ROLLBACK')
-            raise
-        finally:
-            conn.execute('PRAGMA foreign_keys = ON')
+        _rebuild_variant_dependent_tables()
 
     # 1) variants: расширяем допустимые типы (thematic/full + mixed/uploaded)
     cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='variants'")
@@ -161,40 +717,31 @@ def migrate_db():
     if row and row['sql']:
         sql = row['sql']
         if "variant_type IN ('thematic', 'full')" in sql:
-            conn.execute('PRAGMA foreign_keys = OFF')
-            conn.execute('BEGIN')
-            try:
-                cur.execute("ALTER TABLE variants RENAME TO variants_old")
-                cur.execute('''
-                    CREATE TABLE variants (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        name TEXT NOT NULL,
-                        variant_type TEXT NOT NULL CHECK(variant_type IN ('thematic', 'full', 'mixed', 'uploaded')),
-                        ege_number INTEGER,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                cur.execute('''
-                    INSERT INTO variants (id, name, variant_type, ege_number, created_at)
-                    SELECT id, name,
-                           CASE
-                             WHEN variant_type IN ('thematic','full','mixed','uploaded') THEN variant_type
-                             ELSE 'full'
-                           END,
-                           ege_number, created_at
-                    FROM variants_old
-                ''')
+            cur.execute("ALTER TABLE variants RENAME TO variants_old")
+            cur.execute('''
+                CREATE TABLE variants (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    variant_type TEXT NOT NULL CHECK(variant_type IN ('thematic', 'full', 'mixed', 'uploaded')),
+                    ege_number INTEGER,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cur.execute('''
+                INSERT INTO variants (id, name, variant_type, ege_number, created_at)
+                SELECT id, name,
+                       CASE
+                         WHEN variant_type IN ('thematic','full','mixed','uploaded') THEN variant_type
+                         ELSE 'full'
+                       END,
+                       ege_number, created_at
+                FROM variants_old
+            ''')
 
-                # Rebuild dependent tables so their FK points to the new variants
-                _rebuild_variant_dependent_tables()
+            # Rebuild dependent tables so their FK points to the new variants
+            _rebuild_variant_dependent_tables()
 
-                cur.execute("DROP TABLE variants_old")
-                conn.execute('COMMIT')
-            except Exception:
-                conn.execute('ROLLBACK')
-                raise
-            finally:
-                conn.execute('PRAGMA foreign_keys = ON')
+            cur.execute("DROP TABLE variants_old")
 
     # 2) students: last_seen_at (для отслеживания активности)
     if not _table_has_column(conn, 'students', 'last_seen_at'):
@@ -263,13 +810,221 @@ def migrate_db():
     if not _table_has_column(conn, 'answers', 'upload_uploaded_at'):
         cur.execute("ALTER TABLE answers ADD COLUMN upload_uploaded_at DATETIME")
 
-    conn.commit()
-    conn.close()
+
+# Вклад ответа в итоги ученика (_answer_contribution): читается до и после upsert
+_ANSWER_CONTRIBUTION_SQL = '''
+    SELECT a.is_correct AND t.id IS NOT NULL,
+           COALESCE(a.answer_1, a.answer_2, a.answer_text, a.upload_path) IS NOT NULL
+    FROM answers a LEFT JOIN tasks t ON t.id = a.task_id
+    WHERE a.student_id = ? AND a.task_id = ?
+'''
+
+# Запросы, которые выполняются на каждое автосохранение и на страницах результатов
+HOT_QUERIES = {
+    # У INSERT ... ON CONFLICT план в SQLite пустой: показываем поиск по цели
+    # конфликта (student_id, task_id) с чтением client_rev для условия WHERE
+    'Answer.save: upsert': (
+        'SELECT client_rev FROM answers WHERE student_id = ? AND task_id = ?',
+        (0, 0),
+    ),
+    'Answer.save: вклад в итоги': (
+        _ANSWER_CONTRIBUTION_SQL,
+        (0, 0),
+    ),
+    'Student.get_answers': (
+        '''
+        SELECT a.*, t.ege_number, t.answer_1 as correct_1, t.answer_2 as correct_2,
+               t.answer_count, t.image_path
+        FROM answers a
+        JOIN tasks t ON a.task_id = t.id
+        WHERE a.student_id = ?
+        ORDER BY t.ege_number
+        ''',
+        (0,),
+    ),
+    'Variant.get_tasks': (
+        '''
+        SELECT t.*, vt.position FROM tasks t
+        JOIN variant_tasks vt ON t.id = vt.task_id
+        WHERE vt.variant_id = ?
+        ORDER BY vt.position
+        ''',
+        (0,),
+    ),
+}
+
+
+def _migrate_hot_indexes(conn, cur):
+    """Создать вторичные индексы; перед UNIQUE на answers убрать дубли ответов."""
+    plans_before = explain_hot_queries(conn)
+    # Оставляем последнюю запись ответа ученика на задачу
+    cur.execute('''
+        DELETE FROM answers
+        WHERE id NOT IN (SELECT MAX(id) FROM answers GROUP BY student_id, task_id)
+    ''')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_answers_student_task ON answers(student_id, task_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_students_session ON students(session_id, started_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_students_session_name ON students(session_id, first_name, last_name)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_variant_tasks_variant ON variant_tasks(variant_id, position)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_tasks_scope_ege ON tasks(task_scope, ege_number, created_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_tasks_scope_class ON tasks(task_scope, class_id, created_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_test_sessions_status ON test_sessions(status, created_at)')
+    _print_query_plans(plans_before, explain_hot_queries(conn))
+
+
+def _migrate_session_config(conn, cur):
+    """Параметры индивидуального режима: из строк settings в колонки test_sessions."""
+    for col in ('thematic_ege_number', 'thematic_tasks_count'):
+        if not _table_has_column(conn, 'test_sessions', col):
+            cur.execute(f"ALTER TABLE test_sessions ADD COLUMN {col} INTEGER")
+    cur.execute('''
+        UPDATE test_sessions SET
+            thematic_ege_number = COALESCE(thematic_ege_number, (
+                SELECT CAST(value AS INTEGER) FROM settings
+                WHERE key = 'session_' || test_sessions.id || '_ege')),
+            thematic_tasks_count = COALESCE(thematic_tasks_count, (
+                SELECT CAST(value AS INTEGER) FROM settings
+                WHERE key = 'session_' || test_sessions.id || '_count'))
+        WHERE individual_mode = 1
+    ''')
+    cur.execute('''
+        DELETE FROM settings
+        WHERE key GLOB 'session_[0-9]*_ege' OR key GLOB 'session_[0-9]*_count'
+    ''')
+
+
+
+def _migrate_image_dimensions(conn, cur):
+    """Размеры изображений задач: колонки и заполнение по заголовкам PNG."""
+    for col in ('image_width', 'image_height'):
+        if not _table_has_column(conn, 'tasks', col):
+            cur.execute(f"ALTER TABLE tasks ADD COLUMN {col} INTEGER")
+    rows = cur.execute('SELECT id, image_path FROM tasks WHERE image_width IS NULL').fetchall()
+    sizes = []
+    for task_id, image_path in rows:
+        width, height = images.dimensions(os.path.join(IMAGES_DIR, image_path))
+        if width:
+            sizes.append((width, height, task_id))
+    cur.executemany('UPDATE tasks SET image_width = ?, image_height = ? WHERE id = ?', sizes)
+
+
+def _migrate_answer_revisions(conn, cur):
+    """Ревизия ответа от клиента: старые и повторные сохранения не перезаписывают новые."""
+    if not _table_has_column(conn, 'answers', 'client_rev'):
+        cur.execute('ALTER TABLE answers ADD COLUMN client_rev INTEGER NOT NULL DEFAULT 0')
+
+
+def _migrate_answers_task_index(conn, cur):
+    """Индекс ответов по задаче: перепроверка после смены ключа не сканирует всю таблицу."""
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_answers_task ON answers(task_id)')
+
+
+def _migrate_student_scores(conn, cur):
+    """Таблица итогов учеников и её заполнение по уже сохранённым ответам."""
+    cur.execute(STUDENT_SCORES_SQL)
+    _refresh_scores(cur, [row[0] for row in cur.execute('SELECT id FROM students').fetchall()],
+                    criteria=_load_criteria(cur))
+
+
+def explain_hot_queries(conn=None):
+    """EXPLAIN QUERY PLAN для горячих запросов: {имя: [строки плана]}"""
+    own = conn is None
+    if own:
+        conn = get_db()
+    try:
+        plans = {}
+        for name, (sql, params) in HOT_QUERIES.items():
+            try:
+                rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+            except sqlite3.OperationalError as e:
+                # Колонку добавит более поздняя миграция (client_rev — миграция 5)
+                plans[name] = [f'нет плана: {e}']
+                continue
+            plans[name] = [row[3] for row in rows]
+        return plans
+    finally:
+        if own:
+            conn.close()
+
+
+def _print_query_plans(before, after=None):
+    for name, lines in before.items():
+        print(f'[{name}]')
+        if after is None:
+            for line in lines:
+                print(f'    {line}')
+            continue
+        for line in lines:
+            print(f'    до:    {line}')
+        for line in after.get(name, []):
+            print(f'    после: {line}')
+
+
+# Реестр миграций: (версия, описание, функция). Версия базы хранится в PRAGMA user_version,
+# каждая миграция выполняется один раз в своей транзакции. Новые миграции — только в конец.
+MIGRATIONS = [
+    (1, 'Починка старых схем и недостающие колонки', _migrate_legacy_schema),
+    (2, 'Индексы для горячих запросов', _migrate_hot_indexes),
+    (3, 'Типизированные параметры индивидуального режима', _migrate_session_config),
+    (4, 'Размеры изображений задач', _migrate_image_dimensions),
+    (5, 'Ревизии ответов учеников', _migrate_answer_revisions),
+    (6, 'Индекс ответов по задаче', _migrate_answers_task_index),
+    (7, 'Итоги учеников (student_scores)', _migrate_student_scores),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn=None):
+    own = conn is None
+    if own:
+        conn = get_db()
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        if own:
+            conn.close()
+
+
+def migrate_db(dry_run=False):
+    """Применить недостающие миграции; вернуть список [(версия, описание)].
+
+    dry_run=True только сообщает, какие миграции ожидают применения.
+    """
+    conn = get_db()
+    try:
+        current = get_schema_version(conn)
+        pending = [(version, title, fn) for version, title, fn in MIGRATIONS if version > current]
+        if dry_run or not pending:
+            return [(version, title) for version, title, _ in pending]
+
+        cur = conn.cursor()
+        for version, title, fn in pending:
+            # Пересборка таблиц требует отключённых внешних ключей (вне транзакции)
+            conn.execute('PRAGMA foreign_keys = OFF')
+            conn.execute('BEGIN')
+            try:
+                fn(conn, cur)
+                cur.execute(f'PRAGMA user_version = {int(version)}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            finally:
+                conn.execute('PRAGMA foreign_keys = ON')
+        return [(version, title) for version, title, _ in pending]
+    finally:
+        conn.close()
 
 
 def init_db():
-    """Инициализация базы данных"""
+    """Инициализация базы данных: таблицы для новой установки и миграции.
+
+    Для актуальной базы стоит одного чтения PRAGMA user_version.
+    """
     conn = get_db()
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        conn.close()
+        return
     cursor = conn.cursor()
     
     # Таблица классов (для обычных работ, не ЕГЭ)
@@ -290,6 +1045,8 @@ def init_db():
             task_scope TEXT NOT NULL DEFAULT 'ege',
             class_id INTEGER,
             image_path TEXT NOT NULL,
+            image_width INTEGER,
+            image_height INTEGER,
             attachment_path TEXT,
             attachment_name TEXT,
             answer_kind TEXT NOT NULL DEFAULT 'classic',
@@ -349,6 +1106,8 @@ def init_db():
             grade_4_min INTEGER,
             grade_3_min INTEGER,
             total_tasks INTEGER,
+            thematic_ege_number INTEGER,
+            thematic_tasks_count INTEGER,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (variant_id) REFERENCES variants(id)
         )
@@ -381,6 +1140,7 @@ def init_db():
             answer_text TEXT,
             is_correct BOOLEAN,
             answered_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            client_rev INTEGER NOT NULL DEFAULT 0,
             upload_path TEXT,
             upload_name TEXT,
             upload_size INTEGER,
@@ -390,6 +1150,9 @@ def init_db():
         )
     ''')
     
+    # Итоги учеников: пересчитываются при каждой записи ответов, читаются страницами результатов
+    cursor.execute(STUDENT_SCORES_SQL)
+
     # Таблица критериев оценки
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS grade_criteria (
@@ -421,19 +1184,149 @@ def init_db():
     conn.commit()
     conn.close()
 
+    migrate_db()
+
+STUDENT_SCORES_SQL = '''
+    CREATE TABLE IF NOT EXISTS student_scores (
+        student_id INTEGER PRIMARY KEY,
+        correct_count INTEGER NOT NULL DEFAULT 0,
+        answered_count INTEGER NOT NULL DEFAULT 0,
+        total_tasks INTEGER NOT NULL DEFAULT 0,
+        grade INTEGER,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
+    )
+'''
+
+
+_CRITERIA_SQL = 'SELECT total_tasks, grade_5_min, grade_4_min, grade_3_min FROM grade_criteria'
+
+
+def _load_criteria(cursor):
+    return {row['total_tasks']: dict(row) for row in cursor.execute(_CRITERIA_SQL).fetchall()}
+
+
+def _grade_criteria():
+    """Общие критерии оценки из кэша (сбрасывается в GradeCriteria.create_or_update)."""
+    def _load():
+        conn = _read_db()
+        try:
+            return _load_criteria(conn.cursor())
+        finally:
+            conn.close()
+
+    return _criteria.get('all', _load)
+
+
+def _refresh_scores(cursor, student_ids, criteria=None):
+    """Пересчитать student_scores для учеников в текущей транзакции.
+
+    Верные — как на страницах результатов: ответы на существующие задачи с
+    is_correct; всего — задачи варианта; оценка — по критериям сессии или общим
+    (criteria — если они меняются в этой же транзакции).
+    """
+    student_ids = list(set(student_ids))
+    if not student_ids:
+        return
+    if criteria is None:
+        criteria = _grade_criteria()
+    for start in range(0, len(student_ids), REGRADE_BATCH_SIZE):
+        chunk = student_ids[start:start + REGRADE_BATCH_SIZE]
+        rows = cursor.execute(f'''
+            SELECT s.id,
+                   (SELECT COUNT(*) FROM answers a JOIN tasks t ON t.id = a.task_id
+                    WHERE a.student_id = s.id AND a.is_correct) AS correct_count,
+                   (SELECT COUNT(COALESCE(a.answer_1, a.answer_2, a.answer_text, a.upload_path))
+                    FROM answers a WHERE a.student_id = s.id) AS answered_count,
+                   (SELECT COUNT(*) FROM variant_tasks vt WHERE vt.variant_id = s.variant_id) AS total_tasks,
+                   ts.grade_5_min, ts.grade_4_min, ts.grade_3_min
+            FROM students s
+            LEFT JOIN test_sessions ts ON ts.id = s.session_id
+            WHERE s.id IN ({','.join('?' for _ in chunk)})
+        ''', chunk).fetchall()
+        scores = []
+        for row in rows:
+            rules = row if row['grade_5_min'] is not None else criteria.get(row['total_tasks'])
+            grade = GradeCriteria.grade_by(row['correct_count'], row['total_tasks'], rules)
+            scores.append((row['id'], row['correct_count'], row['answered_count'], row['total_tasks'], grade))
+        cursor.executemany('''
+            INSERT INTO student_scores (student_id, correct_count, answered_count, total_tasks, grade, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(student_id) DO UPDATE SET
+                correct_count = excluded.correct_count,
+                answered_count = excluded.answered_count,
+                total_tasks = excluded.total_tasks,
+                grade = excluded.grade,
+                updated_at = CURRENT_TIMESTAMP
+        ''', scores)
+
+
+def _answer_contribution(cursor, student_id, task_id):
+    """Вклад ответа в student_scores: (засчитан верным, есть ответ) — как в _refresh_scores."""
+    row = cursor.execute(_ANSWER_CONTRIBUTION_SQL, (student_id, task_id)).fetchone()
+    return (bool(row[0]), bool(row[1])) if row else (False, False)
+
+
+def _in_closed_session(cursor, student_id):
+    """Ученик закрытой сессии: её анализ заданий кэшируется (_analytics)."""
+    return cursor.execute('''
+        SELECT 1 FROM students s JOIN test_sessions ts ON ts.id = s.session_id
+        WHERE s.id = ? AND ts.status = 'closed'
+    ''', (student_id,)).fetchone() is not None
+
+
+def _apply_score_delta(cursor, student_id, correct_delta, answered_delta):
+    """Сдвинуть итоги ученика на разницу после сохранения его ответов.
+
+    Путь автосохранения: без пересчёта по всем ответам и варианту; оценка
+    пересчитывается, только если изменилось число верных.
+    """
+    if not correct_delta and not answered_delta:
+        return
+    cursor.execute('''
+        UPDATE student_scores
+        SET correct_count = correct_count + ?, answered_count = answered_count + ?,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE student_id = ?
+    ''', (correct_delta, answered_delta, student_id))
+    if not cursor.rowcount:
+        # Строки итогов ещё нет — считаем полностью
+        _refresh_scores(cursor, [student_id])
+        return
+    if not correct_delta:
+        return
+    row = cursor.execute('''
+        SELECT sc.correct_count, sc.total_tasks, ts.grade_5_min, ts.grade_4_min, ts.grade_3_min
+        FROM student_scores sc
+        JOIN students s ON s.id = sc.student_id
+        LEFT JOIN test_sessions ts ON ts.id = s.session_id
+        WHERE sc.student_id = ?
+    ''', (student_id,)).fetchone()
+    rules = row if row['grade_5_min'] is not None else _grade_criteria().get(row['total_tasks'])
+    cursor.execute('UPDATE student_scores SET grade = ? WHERE student_id = ?',
+                   (GradeCriteria.grade_by(row['correct_count'], row['total_tasks'], rules), student_id))
+
+
+def _variant_students(cursor, variant_id):
+    return [row[0] for row in cursor.execute('SELECT id FROM students WHERE variant_id = ?', (variant_id,))]
+
+
 # Функции для работы с задачами
 class Task:
     @staticmethod
     def create(ege_number, image_path, answer_1=None, answer_count=1, answer_2=None,
                attachment_path=None, attachment_name=None, answer_text=None,
-               task_scope='ege', class_id=None, answer_kind='classic'):
+               task_scope='ege', class_id=None, answer_kind='classic',
+               image_width=None, image_height=None):
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO tasks (ege_number, task_scope, class_id, image_path, attachment_path, attachment_name,
+            INSERT INTO tasks (ege_number, task_scope, class_id, image_path, image_width, image_height,
+                             attachment_path, attachment_name,
                              answer_kind, answer_count, answer_1, answer_2, answer_text)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (ege_number, task_scope, class_id, image_path, attachment_path, attachment_name,
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (ege_number, task_scope, class_id, image_path, image_width, image_height,
+              attachment_path, attachment_name,
               answer_kind, answer_count, answer_1, answer_2, answer_text))
         task_id = cursor.lastrowid
         conn.commit()
@@ -442,7 +1335,7 @@ class Task:
     
     @staticmethod
     def get_by_id(task_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM tasks WHERE id = ?', (task_id,))
         task = cursor.fetchone()
@@ -451,7 +1344,7 @@ class Task:
     
     @staticmethod
     def get_by_ege_number(ege_number):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM tasks WHERE task_scope = 'ege' AND ege_number = ? ORDER BY created_at DESC",
                       (ege_number,))
@@ -461,7 +1354,7 @@ class Task:
 
     @staticmethod
     def get_by_class_id(class_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM tasks WHERE task_scope = 'class' AND class_id = ? ORDER BY created_at DESC", (class_id,))
         tasks = [dict(row) for row in cursor.fetchall()]
@@ -470,7 +1363,7 @@ class Task:
     
     @staticmethod
     def get_all(scope=None, class_id=None):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         if scope == 'ege':
             cursor.execute("SELECT * FROM tasks WHERE task_scope = 'ege' ORDER BY ege_number, created_at DESC")
@@ -487,7 +1380,7 @@ class Task:
     @staticmethod
     def count_by_ege_number():
         """Возвращает словарь {номер_ЕГЭ: количество_задач}"""
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute("SELECT ege_number, COUNT(*) as count FROM tasks WHERE task_scope = 'ege' GROUP BY ege_number")
         result = {row['ege_number']: row['count'] for row in cursor.fetchall()}
@@ -496,7 +1389,7 @@ class Task:
 
     @staticmethod
     def count_by_class():
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT c.id as class_id, c.name as class_name, COUNT(t.id) as count
@@ -511,28 +1404,59 @@ class Task:
     
     @staticmethod
     def update(task_id, **kwargs):
+        """Обновить поля задачи. Если изменился ключ ответа, сохранённые ответы
+        перепроверяются; возвращается число ответов, у которых поменялся результат."""
         conn = get_db()
         cursor = conn.cursor()
+        key_sql = 'SELECT answer_count, answer_1, answer_2, answer_text FROM tasks WHERE id = ?'
+        old_key = new_key = None
+        if ANSWER_KEY_FIELDS.intersection(kwargs):
+            old_key = cursor.execute(key_sql, (task_id,)).fetchone()
         fields = []
         values = []
         for key, value in kwargs.items():
-            if key in ['ege_number', 'task_scope', 'class_id', 'image_path', 'attachment_path', 'attachment_name',
+            if key in ['ege_number', 'task_scope', 'class_id', 'image_path', 'image_width', 'image_height',
+                      'attachment_path', 'attachment_name',
                       'answer_kind', 'answer_count', 'answer_1', 'answer_2', 'answer_text']:
                 fields.append(f'{key} = ?')
                 values.append(value)
         if fields:
             values.append(task_id)
             cursor.execute(f'UPDATE tasks SET {", ".join(fields)} WHERE id = ?', values)
+            if old_key is not None:
+                new_key = cursor.execute(key_sql, (task_id,)).fetchone()
             conn.commit()
         conn.close()
+        if fields:
+            _variant_tasks.invalidate()
+            _analytics.invalidate()
+        if old_key is None:
+            return 0
+        # Сохранения проверяют ответ в очереди записи уже по новому ключу, а те, что
+        # успели проверить по старому, исправит перепроверка, поставленная после них
+        _matchers.invalidate()
+        if new_key is not None and tuple(old_key) != tuple(new_key):
+            return Answer.regrade(task_ids=[task_id])['changed']
+        return 0
     
     @staticmethod
     def delete(task_id):
         conn = get_db()
         cursor = conn.cursor()
+        # Ответы на задачу перестают учитываться, а варианты с ней становятся короче
+        affected = [row[0] for row in cursor.execute('''
+            SELECT student_id FROM answers WHERE task_id = ?
+            UNION
+            SELECT s.id FROM students s JOIN variant_tasks vt ON vt.variant_id = s.variant_id
+            WHERE vt.task_id = ?
+        ''', (task_id, task_id))]
         cursor.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
-        conn.commit()
-        conn.close()
+        with _analytics.mutation():
+            _refresh_scores(cursor, affected)
+            conn.commit()
+            conn.close()
+        _variant_tasks.invalidate()
+        _matchers.invalidate()
 
     @staticmethod
     def move_to_class(task_ids, class_id):
@@ -549,13 +1473,14 @@ class Task:
         affected = cursor.rowcount
         conn.commit()
         conn.close()
+        _variant_tasks.invalidate()
         return affected
 
 
 class ClassGroup:
     @staticmethod
     def get_all():
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM classes ORDER BY CASE WHEN name = 'Общий банк' THEN 0 ELSE 1 END, name")
         rows = [dict(row) for row in cursor.fetchall()]
@@ -575,7 +1500,7 @@ class ClassGroup:
 
     @staticmethod
     def get_by_id(class_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM classes WHERE id = ?', (class_id,))
         row = cursor.fetchone()
@@ -623,12 +1548,14 @@ class Variant:
                 INSERT INTO variant_tasks (variant_id, task_id, position)
                 VALUES (?, ?, ?)
             ''', rows)
+            _refresh_scores(cursor, _variant_students(cursor, variant_id))
             conn.commit()
         except Exception:
             conn.rollback()
             raise
         finally:
             conn.close()
+            _variant_tasks.invalidate()
 
     @staticmethod
     def update(variant_id, **kwargs):
@@ -663,40 +1590,56 @@ class Variant:
                     INSERT INTO variant_tasks (variant_id, task_id, position)
                     VALUES (?, ?, ?)
                 ''', rows)
+            _refresh_scores(cursor, _variant_students(cursor, variant_id))
             conn.commit()
         except Exception:
             conn.rollback()
             raise
         finally:
             conn.close()
+            _variant_tasks.invalidate()
     
     @staticmethod
     def get_by_id(variant_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM variants WHERE id = ?', (variant_id,))
         variant = cursor.fetchone()
         conn.close()
         return dict(variant) if variant else None
     
+    @staticmethod
+    def _load_tasks(variant_id):
+        def _load():
+            conn = _read_db()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT t.*, vt.position FROM tasks t
+                JOIN variant_tasks vt ON t.id = vt.task_id
+                WHERE vt.variant_id = ?
+                ORDER BY vt.position
+            ''', (variant_id,))
+            tasks = tuple(dict(row) for row in cursor.fetchall())
+            conn.close()
+            return tasks, frozenset(t['id'] for t in tasks)
+
+        return _variant_tasks.get(variant_id, _load)
+
     @staticmethod
     def get_tasks(variant_id):
         """Получить задачи варианта"""
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT t.*, vt.position FROM tasks t
-            JOIN variant_tasks vt ON t.id = vt.task_id
-            WHERE vt.variant_id = ?
-            ORDER BY vt.position
-        ''', (variant_id,))
-        tasks = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return tasks
+        tasks, _ = Variant._load_tasks(variant_id)
+        return [dict(t) for t in tasks]
+
+    @staticmethod
+    def get_task_ids(variant_id):
+        """Множество id задач варианта (для проверки принадлежности)."""
+        _, task_ids = Variant._load_tasks(variant_id)
+        return task_ids
     
     @staticmethod
     def get_all(scope=None):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         if scope in ('ege', 'class'):
             cursor.execute('SELECT * FROM variants WHERE variant_scope = ? ORDER BY created_at DESC', (scope,))
@@ -723,27 +1666,33 @@ class Variant:
                 return True
 
             # Cascade delete: remove all results and sessions linked to the variant
-            cursor.execute('''
-                DELETE FROM answers
-                WHERE student_id IN (SELECT id FROM students WHERE variant_id = ?)
-            ''', (variant_id,))
-            cursor.execute('DELETE FROM students WHERE variant_id = ?', (variant_id,))
-            cursor.execute('DELETE FROM test_sessions WHERE variant_id = ?', (variant_id,))
-            cursor.execute('DELETE FROM variant_tasks WHERE variant_id = ?', (variant_id,))
-            cursor.execute('DELETE FROM variants WHERE id = ?', (variant_id,))
-            conn.commit()
+            with _sessions.mutation(), _roster.mutation(), _analytics.mutation():
+                cursor.execute('''
+                    DELETE FROM answers
+                    WHERE student_id IN (SELECT id FROM students WHERE variant_id = ?)
+                ''', (variant_id,))
+                cursor.execute('''
+                    DELETE FROM student_scores
+                    WHERE student_id IN (SELECT id FROM students WHERE variant_id = ?)
+                ''', (variant_id,))
+                cursor.execute('DELETE FROM students WHERE variant_id = ?', (variant_id,))
+                cursor.execute('DELETE FROM test_sessions WHERE variant_id = ?', (variant_id,))
+                cursor.execute('DELETE FROM variant_tasks WHERE variant_id = ?', (variant_id,))
+                cursor.execute('DELETE FROM variants WHERE id = ?', (variant_id,))
+                conn.commit()
             return True
         except Exception:
             conn.rollback()
             raise
         finally:
             conn.close()
+            _variant_tasks.invalidate()
 
 # Функции для работы с критериями оценки
 class GradeCriteria:
     @staticmethod
     def get_for_total(total_tasks):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM grade_criteria WHERE total_tasks = ?', (total_tasks,))
         criteria = cursor.fetchone()
@@ -752,7 +1701,7 @@ class GradeCriteria:
     
     @staticmethod
     def get_all():
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM grade_criteria ORDER BY total_tasks')
         criteria = [dict(row) for row in cursor.fetchall()]
@@ -776,8 +1725,14 @@ class GradeCriteria:
                 INSERT INTO grade_criteria (name, total_tasks, grade_5_min, grade_4_min, grade_3_min)
                 VALUES (?, ?, ?, ?, ?)
             ''', (name, total_tasks, grade_5_min, grade_4_min, grade_3_min))
-        conn.commit()
-        conn.close()
+        # Оценки учеников с таким числом задач (у сессий без своих критериев) меняются
+        _refresh_scores(cursor, [row[0] for row in cursor.execute(
+            'SELECT student_id FROM student_scores WHERE total_tasks = ?', (total_tasks,))],
+            criteria=_load_criteria(cursor))
+        with _analytics.mutation():
+            conn.commit()
+            conn.close()
+        _criteria.invalidate()
     
     @staticmethod
     def calculate_grade(correct_count, total_tasks, session_criteria=None):
@@ -786,19 +1741,14 @@ class GradeCriteria:
         session_criteria - словарь с полями grade_5_min, grade_4_min, grade_3_min
                           от конкретной сессии тестирования (если заданы)
         """
-        # Если переданы критерии сессии - используем их
+        # Если переданы критерии сессии - используем их, иначе ищем общие критерии
         if session_criteria and session_criteria.get('grade_5_min') is not None:
-            if correct_count >= session_criteria['grade_5_min']:
-                return 5
-            elif correct_count >= session_criteria['grade_4_min']:
-                return 4
-            elif correct_count >= session_criteria['grade_3_min']:
-                return 3
-            else:
-                return 2
-        
-        # Иначе ищем общие критерии
-        criteria = GradeCriteria.get_for_total(total_tasks)
+            return GradeCriteria.grade_by(correct_count, total_tasks, session_criteria)
+        return GradeCriteria.grade_by(correct_count, total_tasks, GradeCriteria.get_for_total(total_tasks))
+
+    @staticmethod
+    def grade_by(correct_count, total_tasks, criteria):
+        """Оценка по порогам criteria (grade_5_min, grade_4_min, grade_3_min)."""
         if not criteria:
             # Если нет критериев для данного количества задач, используем пропорцию
             percent = correct_count / total_tasks * 100 if total_tasks > 0 else 0
@@ -810,7 +1760,7 @@ class GradeCriteria:
                 return 3
             else:
                 return 2
-        
+
         if correct_count >= criteria['grade_5_min']:
             return 5
         elif correct_count >= criteria['grade_4_min']:
@@ -820,63 +1770,57 @@ class GradeCriteria:
         else:
             return 2
 
-if __name__ == '__main__':
-    init_db()
-    print('База данных инициализирована')
-
 # Функции для работы с тестированиями (сессиями)
 class TestSession:
     @staticmethod
     def create(variant_id, individual_mode, time_limit, access_code, show_answers, teacher_finish_only, calculator_enabled, python_enabled,
                thematic_ege_number=None, thematic_tasks_count=None,
                grade_5_min=None, grade_4_min=None, grade_3_min=None, total_tasks=None):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO test_sessions (variant_id, individual_mode, time_limit, 
-                                       access_code, show_answers, teacher_finish_only, calculator_enabled, python_enabled, status,
-                                       grade_5_min, grade_4_min, grade_3_min, total_tasks)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, ?, ?, ?)
-        ''', (variant_id, individual_mode, time_limit, access_code, show_answers, teacher_finish_only, calculator_enabled, python_enabled,
-              grade_5_min, grade_4_min, grade_3_min, total_tasks))
-        session_id = cursor.lastrowid
-        
-        # Сохраняем настройки для индивидуальных вариантов
-        if individual_mode and thematic_ege_number is not None:
-            cursor.execute('''
-                INSERT INTO settings (key, value) VALUES (?, ?)
-                ON CONFLICT(key) DO UPDATE SET value = ?
-            ''', (f'session_{session_id}_ege', str(thematic_ege_number), str(thematic_ege_number)))
+        def _write(cursor):
             cursor.execute('''
-                INSERT INTO settings (key, value) VALUES (?, ?)
-                ON CONFLICT(key) DO UPDATE SET value = ?
-            ''', (f'session_{session_id}_count', str(thematic_tasks_count), str(thematic_tasks_count)))
-        
-        conn.commit()
-        conn.close()
-        return session_id
+                INSERT INTO test_sessions (variant_id, individual_mode, time_limit, 
+                                           access_code, show_answers, teacher_finish_only, calculator_enabled, python_enabled, status,
+                                           grade_5_min, grade_4_min, grade_3_min, total_tasks,
+                                           thematic_ege_number, thematic_tasks_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, ?, ?, ?, ?, ?)
+            ''', (variant_id, individual_mode, time_limit, access_code, show_answers, teacher_finish_only, calculator_enabled, python_enabled,
+                  grade_5_min, grade_4_min, grade_3_min, total_tasks,
+                  thematic_ege_number if individual_mode else None,
+                  thematic_tasks_count if individual_mode else None))
+            return cursor.lastrowid
+
+        with _sessions.mutation():
+            return _writer.call(_write)
     
     @staticmethod
     def get_by_id(session_id):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM test_sessions WHERE id = ?', (session_id,))
-        session = cursor.fetchone()
-        conn.close()
+        def _load():
+            conn = _read_db()
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM test_sessions WHERE id = ?', (session_id,))
+            session = cursor.fetchone()
+            conn.close()
+            return dict(session) if session else None
+
+        session = _sessions.get(session_id, _load)
         return dict(session) if session else None
     
     @staticmethod
     def get_active():
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM test_sessions WHERE status = 'active' ORDER BY created_at DESC LIMIT 1")
-        session = cursor.fetchone()
-        conn.close()
+        def _load():
+            conn = _read_db()
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM test_sessions WHERE status = 'active' ORDER BY created_at DESC LIMIT 1")
+            session = cursor.fetchone()
+            conn.close()
+            return dict(session) if session else None
+
+        session = _sessions.get(_ACTIVE_SESSION, _load)
         return dict(session) if session else None
     
     @staticmethod
     def get_all():
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM test_sessions ORDER BY created_at DESC')
         sessions = [dict(row) for row in cursor.fetchall()]
@@ -885,64 +1829,158 @@ class TestSession:
     
     @staticmethod
     def close(session_id):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE test_sessions SET status = 'closed' WHERE id = ?", (session_id,))
-        conn.commit()
-        conn.close()
+        def _write(cursor):
+            cursor.execute("UPDATE test_sessions SET status = 'closed' WHERE id = ?", (session_id,))
+
+        with _sessions.mutation():
+            _writer.call(_write)
+        _session_events.notify(session_id)
 
     @staticmethod
     def pause(session_id):
-        conn = get_db()
+        def _write(cursor):
+            cursor.execute('''
+                UPDATE test_sessions
+                SET paused = 1, paused_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'active' AND paused = 0
+            ''', (session_id,))
+
+        with _sessions.mutation():
+            _writer.call(_write)
+        _session_events.notify(session_id)
+
+    @staticmethod
+    def resume(session_id):
+        def _write(cursor):
+            cursor.execute('SELECT paused, paused_at, pause_total_seconds FROM test_sessions WHERE id = ?', (session_id,))
+            row = cursor.fetchone()
+            if row and row['paused'] and row['paused_at']:
+                try:
+                    paused_at = datetime.fromisoformat(row['paused_at'])
+                    delta = int((datetime.now(timezone.utc).replace(tzinfo=None) - paused_at).total_seconds())
+                except Exception:
+                    delta = 0
+                cursor.execute('''
+                    UPDATE test_sessions
+                    SET paused = 0, paused_at = NULL, pause_total_seconds = pause_total_seconds + ?
+                    WHERE id = ?
+                ''', (delta, session_id))
+            else:
+                cursor.execute('UPDATE test_sessions SET paused = 0, paused_at = NULL WHERE id = ?', (session_id,))
+
+        with _sessions.mutation():
+            _writer.call(_write)
+        _session_events.notify(session_id)
+
+    @staticmethod
+    def extend_time(session_id, extra_seconds):
+        def _write(cursor):
+            cursor.execute('''
+                UPDATE test_sessions
+                SET extra_seconds = extra_seconds + ?
+                WHERE id = ?
+            ''', (extra_seconds, session_id))
+
+        with _sessions.mutation():
+            _writer.call(_write)
+        _session_events.notify(session_id)
+    
+    @staticmethod
+    def event_seq(session_id):
+        """Текущий номер изменения сессии (пауза, продление, закрытие...)."""
+        return _session_events.current(session_id)
+
+    @staticmethod
+    def wait_event(session_id, seen_seq, timeout):
+        """Дождаться изменения сессии после seen_seq; вернуть новый номер."""
+        return _session_events.wait(session_id, seen_seq, timeout)
+
+    @staticmethod
+    def get_students(session_id):
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
-            UPDATE test_sessions
-            SET paused = 1, paused_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND status = 'active' AND paused = 0
+            SELECT * FROM students WHERE session_id = ? ORDER BY started_at DESC
         ''', (session_id,))
-        conn.commit()
+        students = [dict(row) for row in cursor.fetchall()]
         conn.close()
+        return students
 
     @staticmethod
-    def resume(session_id):
-        conn = get_db()
+    def get_students_with_scores(session_id):
+        """Ученики сессии вместе с итогами из student_scores одним запросом."""
+        conn = _read_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT paused, paused_at, pause_total_seconds FROM test_sessions WHERE id = ?', (session_id,))
-        row = cursor.fetchone()
-        if row and row['paused'] and row['paused_at']:
-            try:
-                paused_at = datetime.fromisoformat(row['paused_at'])
-                delta = int((datetime.now(timezone.utc).replace(tzinfo=None) - paused_at).total_seconds())
-            except Exception:
-                delta = 0
-            cursor.execute('''
-                UPDATE test_sessions
-                SET paused = 0, paused_at = NULL, pause_total_seconds = pause_total_seconds + ?
-                WHERE id = ?
-            ''', (delta, session_id))
-        else:
-            cursor.execute('UPDATE test_sessions SET paused = 0, paused_at = NULL WHERE id = ?', (session_id,))
-        conn.commit()
+        cursor.execute('''
+            SELECT s.*,
+                   COALESCE(sc.correct_count, 0) AS correct_count,
+                   COALESCE(sc.answered_count, 0) AS answered_count,
+                   COALESCE(sc.total_tasks, 0) AS total_tasks,
+                   sc.grade
+            FROM students s
+            LEFT JOIN student_scores sc ON sc.student_id = s.id
+            WHERE s.session_id = ?
+            ORDER BY s.started_at DESC
+        ''', (session_id,))
+        students = [dict(row) for row in cursor.fetchall()]
         conn.close()
+        return students
 
     @staticmethod
-    def extend_time(session_id, extra_seconds):
-        conn = get_db()
+    def get_correctness_rows(session_id):
+        """(student_id, task_id, ege_number, correct) для завершивших учеников сессии одним запросом.
+
+        Строка есть для каждой задачи варианта ученика; без ответа — correct = 0.
+        """
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
-            UPDATE test_sessions
-            SET extra_seconds = extra_seconds + ?
-            WHERE id = ?
-        ''', (extra_seconds, session_id))
-        conn.commit()
+            SELECT s.id, vt.task_id, t.ege_number, COALESCE(a.is_correct, 0)
+            FROM students s
+            JOIN variant_tasks vt ON vt.variant_id = s.variant_id
+            JOIN tasks t ON t.id = vt.task_id
+            LEFT JOIN answers a ON a.student_id = s.id AND a.task_id = vt.task_id
+            WHERE s.session_id = ? AND s.status = 'finished'
+        ''', (session_id,))
+        rows = [tuple(row) for row in cursor.fetchall()]
         conn.close()
-    
+        return rows
+
     @staticmethod
-    def get_students(session_id):
-        conn = get_db()
+    def get_item_analysis(session_id):
+        """Анализ заданий сессии (analytics.item_analysis) или None, если сессии нет.
+
+        Итоги закрытой сессии меняют только перепроверки, отметки учителя,
+        правки задач и поздние сохранения из очереди клиента, поэтому её анализ
+        кэшируется до такой записи; анализ идущей сессии считается заново.
+        Результат не изменять.
+        """
+        session = TestSession.get_by_id(session_id)
+        if not session:
+            return None
+
+        def _load():
+            with read_snapshot():
+                return analytics.item_analysis(TestSession.get_correctness_rows(session_id))
+
+        if session['status'] != 'closed':
+            return _load()
+        return _analytics.get(session_id, _load)
+
+    @staticmethod
+    def get_monitor_rows(session_id):
+        """Ученики сессии для мониторинга: вместе с числом ответов и загрузок одним запросом."""
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT * FROM students WHERE session_id = ? ORDER BY started_at DESC
+            SELECT s.*,
+                   COUNT(a.upload_path) AS file_uploads_count,
+                   COUNT(COALESCE(a.answer_1, a.answer_2, a.answer_text)) AS answered_count
+            FROM students s
+            LEFT JOIN answers a ON a.student_id = s.id
+            WHERE s.session_id = ?
+            GROUP BY s.id
+            ORDER BY s.started_at DESC
         ''', (session_id,))
         students = [dict(row) for row in cursor.fetchall()]
         conn.close()
@@ -950,46 +1988,42 @@ class TestSession:
 
     @staticmethod
     def delete_with_results(session_id):
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
+        def _write(cursor):
             cursor.execute('''
                 DELETE FROM answers
                 WHERE student_id IN (SELECT id FROM students WHERE session_id = ?)
             ''', (session_id,))
+            cursor.execute('''
+                DELETE FROM student_scores
+                WHERE student_id IN (SELECT id FROM students WHERE session_id = ?)
+            ''', (session_id,))
             cursor.execute('DELETE FROM students WHERE session_id = ?', (session_id,))
             cursor.execute('DELETE FROM test_sessions WHERE id = ?', (session_id,))
-            conn.commit()
             return cursor.rowcount > 0
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+
+        with _sessions.mutation(), _roster.mutation(), _analytics.mutation():
+            deleted = _writer.call(_write)
+        _session_events.notify(session_id)
+        return deleted
 
 
 class Student:
     @staticmethod
     def create(session_id, first_name, last_name, variant_id):
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
+        def _write(cursor):
             cursor.execute('''
                 INSERT INTO students (session_id, first_name, last_name, variant_id, status)
                 VALUES (?, ?, ?, ?, 'in_progress')
             ''', (session_id, first_name, last_name, variant_id))
             student_id = cursor.lastrowid
-            conn.commit()
+            _refresh_scores(cursor, [student_id])
             return student_id
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+
+        return _writer.call(_write)
     
     @staticmethod
     def get_by_id(student_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM students WHERE id = ?', (student_id,))
         student = cursor.fetchone()
@@ -998,7 +2032,7 @@ class Student:
     
     @staticmethod
     def get_by_session_and_name(session_id, first_name, last_name):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT * FROM students 
@@ -1009,57 +2043,77 @@ class Student:
         return dict(student) if student else None
 
     @staticmethod
-    def touch(student_id):
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE students SET last_seen_at = CURRENT_TIMESTAMP WHERE id = ?
-            ''', (student_id,))
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+    def roster_version():
+        """Номер версии состава учеников: меняется, когда учеников удаляют."""
+        return _roster.version
+
+    @staticmethod
+    def get_exam_state(student_id):
+        """Ученик и состояние его сессии одним запросом (для /test/ping и /test/events).
+
+        deadline_ts — момент окончания без учёта текущей паузы (unix-время),
+        paused_at_ts — начало текущей паузы.
+        """
+        conn = _read_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT st.id, st.session_id, st.status AS student_status,
+                   ts.status AS session_status, ts.paused, ts.time_limit, ts.extra_seconds,
+                   CAST(strftime('%s', st.started_at) AS INTEGER)
+                       + ts.time_limit * 60 + ts.extra_seconds + ts.pause_total_seconds AS deadline_ts,
+                   CAST(strftime('%s', ts.paused_at) AS INTEGER) AS paused_at_ts
+            FROM students st
+            JOIN test_sessions ts ON ts.id = st.session_id
+            WHERE st.id = ?
+        ''', (student_id,))
+        state = cursor.fetchone()
+        conn.close()
+        return dict(state) if state else None
+
+    @staticmethod
+    def touch(student_id, fresh_seconds=0):
+        """Отметить активность ученика (запись в БД — пачкой в фоне).
+
+        fresh_seconds > 0 пропускает отметку, если она и так свежая.
+        """
+        _presence.touch(student_id, fresh_seconds)
+
+    @staticmethod
+    def get_last_seen(student_id):
+        """Последняя отметка активности из памяти (None, если её там нет)."""
+        return _presence.get(student_id)
     
     @staticmethod
     def finish(student_id):
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
+        def _write(cursor):
             cursor.execute('''
                 UPDATE students 
                 SET status = 'finished', finished_at = CURRENT_TIMESTAMP 
                 WHERE id = ?
             ''', (student_id,))
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+            _refresh_scores(cursor, [student_id])
+
+        with _analytics.mutation():
+            _writer.call(_write)
 
     @staticmethod
     def finish_all(session_id):
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
+        def _write(cursor):
+            finishing = [row[0] for row in cursor.execute(
+                "SELECT id FROM students WHERE session_id = ? AND status != 'finished'", (session_id,))]
             cursor.execute('''
                 UPDATE students
                 SET status = 'finished', finished_at = CURRENT_TIMESTAMP
                 WHERE session_id = ? AND status != 'finished'
             ''', (session_id,))
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+            _refresh_scores(cursor, finishing)
+
+        with _analytics.mutation():
+            _writer.call(_write)
     
     @staticmethod
     def get_answers(student_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT a.*, t.ege_number, t.answer_1 as correct_1, t.answer_2 as correct_2, 
@@ -1075,106 +2129,185 @@ class Student:
 
 
 class Answer:
+    # Сохраняем или обновляем ответ одним upsert (UNIQUE(student_id, task_id))
+    # Ревизия 0 — сохранение без ревизии (старый клиент), оно всегда применяется
+    _UPSERT_SQL = '''
+        INSERT INTO answers (student_id, task_id, answer_1, answer_2, answer_text, is_correct, client_rev)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(student_id, task_id) DO UPDATE SET
+            answer_1 = excluded.answer_1,
+            answer_2 = excluded.answer_2,
+            answer_text = excluded.answer_text,
+            is_correct = excluded.is_correct,
+            client_rev = MAX(answers.client_rev, excluded.client_rev),
+            answered_at = CURRENT_TIMESTAMP
+        WHERE excluded.client_rev = 0 OR excluded.client_rev > answers.client_rev
+    '''
+    # Результат save(): ревизия не новее записанной, ответ не изменён
+    STALE = object()
+
     @staticmethod
-    def save(student_id, task_id, answer_1=None, answer_2=None, answer_text=None):
-        conn = get_db()
-        cursor = conn.cursor()
+    def check(task, answer_1=None, answer_2=None, answer_text=None):
+        """Проверить ответ по ключу задачи (строка tasks с полями answer_*)."""
+        return grading.grade(task, answer_1, answer_2, answer_text)
+
+    @staticmethod
+    def _get_matchers(task_ids):
+        """Скомпилированные ключи задач {task_id: сравниватель}; нет задачи — нет ключа."""
+        def _load(missing):
+            # Правильные ответы читаем вне транзакции записи
+            conn = _read_db()
+            try:
+                placeholders = ','.join('?' for _ in missing)
+                rows = conn.execute(
+                    f'SELECT id, answer_1, answer_2, answer_count, answer_text FROM tasks WHERE id IN ({placeholders})',
+                    list(missing)).fetchall()
+            finally:
+                conn.close()
+            return {row['id']: grading.compile_key(row) for row in rows}
 
-        def _norm_atom(v):
-            if v is None:
-                return None
-            s = str(v).strip()
-            if s == '':
-                return None
-            # Сжимаем пробелы внутри (часто вводят случайные пробелы)
-            s = ' '.join(s.split())
-            return s
-
-        def _is_int_like(s: str) -> bool:
-            if s is None:
-                return False
-            if s.startswith(('+', '-')):
-                return s[1:].isdigit() and len(s) > 1
-            return s.isdigit()
-
-        def _equal(a, b) -> bool:
-            a = _norm_atom(a)
-            b = _norm_atom(b)
-            if a is None or b is None:
-                return False
-            # Если оба ответа выглядят как целые числа — сравниваем как числа
-            if _is_int_like(a) and _is_int_like(b):
+        return _matchers.get_many(task_ids, _load)
+
+    @staticmethod
+    def save(student_id, task_id, answer_1=None, answer_2=None, answer_text=None, client_rev=None):
+        """Сохранить ответ и вернуть is_correct (None — не проверяется автоматически).
+
+        Answer.STALE — ревизия не новее уже записанной, ничего не изменено.
+        """
+        if _answer_revs.is_stale(student_id, task_id, client_rev):
+            return Answer.STALE
+        # Поздние сохранения (очередь клиента после закрытия) меняют анализ закрытой сессии
+        frozen = []
+        def _write(cursor):
+            # Ключ берётся в момент записи: перепроверка после смены ключа стоит в той же
+            # очереди, и сохранение, проверенное старым ключом, не может лечь после неё
+            matcher = Answer._get_matchers([task_id]).get(task_id, grading.UNCHECKED)
+            is_correct = matcher.grade(answer_1, answer_2, answer_text)
+            old = _answer_contribution(cursor, student_id, task_id)
+            cursor.execute(Answer._UPSERT_SQL, (student_id, task_id, answer_1, answer_2, answer_text,
+                                                is_correct, client_rev or 0))
+            if not cursor.rowcount:
+                return Answer.STALE
+            new = _answer_contribution(cursor, student_id, task_id)
+            _apply_score_delta(cursor, student_id, new[0] - old[0], new[1] - old[1])
+            if new[0] != old[0] and _in_closed_session(cursor, student_id):
+                frozen.append(student_id)
+            return is_correct
+
+        result = _writer.call(_write)
+        if frozen:
+            _analytics.invalidate()
+        _answer_revs.record(student_id, task_id, client_rev)
+        return result
+
+    @staticmethod
+    def save_many(student_id, items):
+        """Сохранить несколько ответов одной транзакцией.
+
+        items — список (task_id, answer_1, answer_2, answer_text, client_rev). Возвращает
+        по порядку {'task_id', 'is_correct', 'rev'}, {'task_id', 'error'} или
+        {'task_id', 'stale': True, 'rev', 'conflict'} — ревизия не новее записанной,
+        ответ не изменён (см. describe_stale). Если все ответы устарели, транзакция
+        записи не открывается.
+        """
+        results = [None] * len(items)
+        fresh = []
+        for pos, item in enumerate(items):
+            if _answer_revs.is_stale(student_id, item[0], item[4]):
+                results[pos] = {'task_id': item[0], 'stale': True}
+            else:
+                fresh.append((pos, item))
+        if fresh:
+            Answer._write_many(student_id, fresh, results)
+        stale = [pos for pos, res in enumerate(results) if res.get('stale')]
+        if stale:
+            for pos, res in zip(stale, Answer.describe_stale(student_id, [items[pos] for pos in stale])):
+                results[pos] = res
+        return results
+
+    @staticmethod
+    def _write_many(student_id, fresh, results):
+        frozen = []
+        def _write(cursor):
+            # Как и в save(): ключи задач — на момент записи
+            matchers = Answer._get_matchers({item[0] for _, item in fresh})
+            correct_delta = answered_delta = 0
+            regraded = False
+            for pos, (task_id, answer_1, answer_2, answer_text, client_rev) in fresh:
+                matcher = matchers.get(task_id)
+                if matcher is None:
+                    results[pos] = {'task_id': task_id, 'error': 'Задача не найдена'}
+                    continue
+                is_correct = matcher.grade(answer_1, answer_2, answer_text)
+                # Ошибка одного ответа не откатывает остальные
+                cursor.execute('SAVEPOINT item')
                 try:
-                    return int(a) == int(b)
-                except Exception:
-                    pass
-            # Иначе — регистронезависимое сравнение (работает и для кириллицы)
-            return a.casefold() == b.casefold()
-        
+                    old = _answer_contribution(cursor, student_id, task_id)
+                    cursor.execute(Answer._UPSERT_SQL, (student_id, task_id, answer_1, answer_2,
+                                                        answer_text, is_correct, client_rev or 0))
+                    stale = not cursor.rowcount
+                    new = old if stale else _answer_contribution(cursor, student_id, task_id)
+                except sqlite3.Error as exc:
+                    cursor.execute('ROLLBACK TO item')
+                    cursor.execute('RELEASE item')
+                    results[pos] = {'task_id': task_id, 'error': str(exc)}
+                    continue
+                cursor.execute('RELEASE item')
+                correct_delta += new[0] - old[0]
+                answered_delta += new[1] - old[1]
+                regraded = regraded or new[0] != old[0]
+                results[pos] = ({'task_id': task_id, 'stale': True} if stale
+                                else {'task_id': task_id, 'is_correct': is_correct, 'rev': client_rev or 0})
+            _apply_score_delta(cursor, student_id, correct_delta, answered_delta)
+            if regraded and _in_closed_session(cursor, student_id):
+                frozen.append(student_id)
+
+        _writer.call(_write)
+        if frozen:
+            _analytics.invalidate()
+        for pos, item in fresh:
+            if 'error' not in results[pos]:
+                _answer_revs.record(student_id, item[0], item[4])
+
+    @staticmethod
+    def describe_stale(student_id, items):
+        """Результаты для неприменённых (устаревших) ответов items по записанным в БД.
+
+        rev — записанная ревизия; conflict — записан другой ответ, он в 'stored'.
+        """
+        # Сравнение в SQL: присланные значения приводятся к типам колонок так же,
+        # как при записи ('05' в answer_1 INTEGER хранится как 5)
+        sent = ','.join('(?, ?, ?, ?, ?)' for _ in items)
+        params = [value for pos, item in enumerate(items) for value in (pos,) + tuple(item[:4])] + [student_id]
+        conn = _read_db()
         try:
-            # Получаем правильные ответы
-            cursor.execute('SELECT answer_1, answer_2, answer_count, answer_text FROM tasks WHERE id = ?', (task_id,))
-            task = cursor.fetchone()
-            
-            # Проверяем правильность
-            is_correct = None  # None = не проверено/неприменимо (например, текстовый ответ)
-            if task:
-                if task['answer_count'] == 0:
-                    # Текстовый/многострочный ответ: сравниваем с эталоном, если он задан.
-                    # Иначе оставляем None (можно проверить вручную).
-                    correct_text = task['answer_text']
-                    if correct_text is not None and str(correct_text).strip() != '':
-                        def norm(s: str) -> str:
-                            return '\n'.join(' '.join(line.strip().split()) for line in str(s).strip().splitlines() if line.strip() != '')
-                        is_correct = (norm(answer_text or '') == norm(correct_text))
-                    else:
-                        is_correct = None
-                elif task['answer_count'] == 1:
-                    is_correct = _equal(answer_1, task['answer_1'])
-                elif task['answer_count'] == 2:
-                    is_correct = (_equal(answer_1, task['answer_1']) and _equal(answer_2, task['answer_2']))
-                else:
-                    count = int(task['answer_count'])
-                    expected = [task['answer_1'], task['answer_2']]
-                    extra_expected = [line.strip() for line in str(task['answer_text'] or '').splitlines()]
-                    for idx in range(2, count):
-                        expected.append(extra_expected[idx - 2] if idx - 2 < len(extra_expected) else None)
-
-                    provided = [answer_1, answer_2]
-                    extra_provided = [line.strip() for line in str(answer_text or '').splitlines()]
-                    for idx in range(2, count):
-                        provided.append(extra_provided[idx - 2] if idx - 2 < len(extra_provided) else None)
-
-                    is_correct = all(_equal(provided[i], expected[i]) for i in range(count))
-
-            # Сохраняем или обновляем ответ
-            cursor.execute('SELECT id FROM answers WHERE student_id = ? AND task_id = ?', 
-                          (student_id, task_id))
-            existing = cursor.fetchone()
-            
-            if existing:
-                cursor.execute('''
-                    UPDATE answers SET answer_1 = ?, answer_2 = ?, answer_text = ?, is_correct = ?,
-                                       answered_at = CURRENT_TIMESTAMP
-                    WHERE student_id = ? AND task_id = ?
-                ''', (answer_1, answer_2, answer_text, is_correct, student_id, task_id))
-            else:
-                cursor.execute('''
-                    INSERT INTO answers (student_id, task_id, answer_1, answer_2, answer_text, is_correct)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (student_id, task_id, answer_1, answer_2, answer_text, is_correct))
-            
-            conn.commit()
-            return is_correct
-        except Exception:
-            conn.rollback()
-            raise
+            rows = conn.execute(f'''
+                WITH sent(pos, task_id, answer_1, answer_2, answer_text) AS (VALUES {sent})
+                SELECT s.task_id, a.id IS NOT NULL AS found,
+                       a.answer_1, a.answer_2, a.answer_text, a.client_rev AS rev,
+                       a.answer_1 IS s.answer_1 AND a.answer_2 IS s.answer_2
+                           AND a.answer_text IS s.answer_text AS same
+                FROM sent s
+                LEFT JOIN answers a ON a.student_id = ? AND a.task_id = s.task_id
+                ORDER BY s.pos
+            ''', params).fetchall()
         finally:
             conn.close()
+
+        results = []
+        for row in rows:
+            res = {'task_id': row['task_id'], 'stale': True, 'rev': row['rev'] if row['found'] else 0,
+                   'conflict': False}
+            if row['found'] and not row['same']:
+                res['conflict'] = True
+                res['stored'] = {field: None if row[field] is None else str(row[field])
+                                 for field in ('answer_1', 'answer_2', 'answer_text')}
+            results.append(res)
+        return results
     
     @staticmethod
     def get_for_student_task(student_id, task_id):
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT * FROM answers WHERE student_id = ? AND task_id = ?
@@ -1183,44 +2316,48 @@ class Answer:
         conn.close()
         return dict(answer) if answer else None
 
+    @staticmethod
+    def get_for_student(student_id):
+        """Все ответы ученика одним запросом: {task_id: answer}."""
+        conn = _read_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM answers WHERE student_id = ?', (student_id,))
+        answers = {row['task_id']: dict(row) for row in cursor.fetchall()}
+        conn.close()
+        return answers
+
     @staticmethod
     def save_upload(student_id, task_id, upload_path, upload_name, upload_size):
         """Сохранить/обновить загруженный учеником файл (file_upload задача)."""
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT id FROM answers WHERE student_id = ? AND task_id = ?',
-                (student_id, task_id)
-            )
-            existing = cursor.fetchone()
-            if existing:
-                cursor.execute('''
-                    UPDATE answers
-                    SET upload_path = ?, upload_name = ?, upload_size = ?,
-                        upload_uploaded_at = CURRENT_TIMESTAMP,
-                        is_correct = NULL,
-                        answered_at = CURRENT_TIMESTAMP
-                    WHERE student_id = ? AND task_id = ?
-                ''', (upload_path, upload_name, upload_size, student_id, task_id))
-            else:
-                cursor.execute('''
-                    INSERT INTO answers
-                        (student_id, task_id, upload_path, upload_name, upload_size,
-                         upload_uploaded_at, is_correct)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, NULL)
-                ''', (student_id, task_id, upload_path, upload_name, upload_size))
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        frozen = []
+        def _write(cursor):
+            old = _answer_contribution(cursor, student_id, task_id)
+            cursor.execute('''
+                INSERT INTO answers
+                    (student_id, task_id, upload_path, upload_name, upload_size,
+                     upload_uploaded_at, is_correct)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, NULL)
+                ON CONFLICT(student_id, task_id) DO UPDATE SET
+                    upload_path = excluded.upload_path,
+                    upload_name = excluded.upload_name,
+                    upload_size = excluded.upload_size,
+                    upload_uploaded_at = CURRENT_TIMESTAMP,
+                    is_correct = NULL,
+                    answered_at = CURRENT_TIMESTAMP
+            ''', (student_id, task_id, upload_path, upload_name, upload_size))
+            new = _answer_contribution(cursor, student_id, task_id)
+            _apply_score_delta(cursor, student_id, new[0] - old[0], new[1] - old[1])
+            if new[0] != old[0] and _in_closed_session(cursor, student_id):
+                frozen.append(student_id)
+
+        _writer.call(_write)
+        if frozen:
+            _analytics.invalidate()
 
     @staticmethod
     def count_uploads_for_student(student_id):
         """Вернуть количество загруженных файлов для ученика (upload_path IS NOT NULL)."""
-        conn = get_db()
+        conn = _read_db()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT COUNT(*) FROM answers WHERE student_id = ? AND upload_path IS NOT NULL',
@@ -1230,29 +2367,84 @@ class Answer:
         conn.close()
         return count
 
+    @staticmethod
+    def regrade(task_ids=None, session_id=None):
+        """Перепроверить сохранённые ответы по текущим ключам задач.
+
+        Область — задачи task_ids и/или ученики сессии session_id. Все строки
+        читаются и обновляются в одной транзакции писателя, изменённые
+        записываются пачками executemany. Ответы на file_upload-задачи не
+        трогаются: их отмечает учитель. Возвращает {'checked', 'changed'}.
+        """
+        conditions = ["t.answer_kind != 'file_upload'"]
+        params = []
+        if task_ids is not None:
+            task_ids = list(task_ids)
+            if not task_ids:
+                return {'checked': 0, 'changed': 0}
+            conditions.append(f"a.task_id IN ({','.join('?' for _ in task_ids)})")
+            params.extend(task_ids)
+        if session_id is not None:
+            conditions.append('a.student_id IN (SELECT id FROM students WHERE session_id = ?)')
+            params.append(session_id)
+
+        def _write(cursor):
+            rows = cursor.execute(f'''
+                SELECT a.id, a.student_id, a.task_id, a.answer_1, a.answer_2, a.answer_text, a.is_correct,
+                       t.answer_count, t.answer_1 AS key_1, t.answer_2 AS key_2, t.answer_text AS key_text
+                FROM answers a
+                JOIN tasks t ON t.id = a.task_id
+                WHERE {' AND '.join(conditions)}
+            ''', params).fetchall()
+            matchers = {}
+            changed = []
+            students = set()
+            for row in rows:
+                matcher = matchers.get(row['task_id'])
+                if matcher is None:
+                    matcher = matchers[row['task_id']] = grading.compile_key({
+                        'answer_count': row['answer_count'], 'answer_1': row['key_1'],
+                        'answer_2': row['key_2'], 'answer_text': row['key_text'],
+                    })
+                is_correct = matcher.grade(row['answer_1'], row['answer_2'], row['answer_text'])
+                stored = None if row['is_correct'] is None else bool(row['is_correct'])
+                if stored != is_correct:
+                    changed.append((is_correct, row['id']))
+                    students.add(row['student_id'])
+            for start in range(0, len(changed), REGRADE_BATCH_SIZE):
+                cursor.executemany('UPDATE answers SET is_correct = ? WHERE id = ?',
+                                   changed[start:start + REGRADE_BATCH_SIZE])
+            _refresh_scores(cursor, students)
+            return {'checked': len(rows), 'changed': len(changed)}
+
+        with _analytics.mutation():
+            return _writer.call(_write)
+
     @staticmethod
     def mark(student_id, task_id, is_correct):
         """Учитель вручную выставляет ✓/✗ для file_upload задачи."""
-        conn = get_db()
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT id FROM answers WHERE student_id = ? AND task_id = ?',
-                (student_id, task_id)
-            )
-            existing = cursor.fetchone()
-            if existing:
-                cursor.execute('''
-                    UPDATE answers SET is_correct = ? WHERE student_id = ? AND task_id = ?
-                ''', (is_correct, student_id, task_id))
-            else:
-                cursor.execute('''
-                    INSERT INTO answers (student_id, task_id, is_correct)
-                    VALUES (?, ?, ?)
-                ''', (student_id, task_id, is_correct))
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        def _write(cursor):
+            cursor.execute('''
+                INSERT INTO answers (student_id, task_id, is_correct)
+                VALUES (?, ?, ?)
+                ON CONFLICT(student_id, task_id) DO UPDATE SET is_correct = excluded.is_correct
+            ''', (student_id, task_id, is_correct))
+            _refresh_scores(cursor, [student_id])
+
+        with _analytics.mutation():
+            _writer.call(_write)
+
+
+if __name__ == '__main__':
+    if '--dry-run' in sys.argv:
+        pending = migrate_db(dry_run=True)
+        print(f'Версия схемы: {get_schema_version()} (актуальная {SCHEMA_VERSION})')
+        for version, title in pending:
+            print(f'  ожидает: {version} — {title}')
+        if not pending:
+            print('Миграций к применению нет')
+        sys.exit(0)
+    init_db()
+    print('База данных инициализирована')
+    if '--explain' in sys.argv:
+        _print_query_plans(explain_hot_queries())
@@ -90,6 +90,11 @@ def main():
         print("[ERROR] Pyodide extracted incorrectly. Required runtime files are missing.")
         return 1
 
+    print("Precompressing runtime...")
+    from precompress_static import precompress
+    files, written = precompress(DEST_DIR)
+    print(f"Precompressed {written} file(s) out of {files}.")
+
     print("Done. Pyodide should be in", DEST_DIR)
     return 0
 
@@ -0,0 +1,104 @@
+"""Create .gz (and .br, if the brotli package is installed) copies of static files.
+
+The server returns these copies to browsers that accept the matching
+Content-Encoding. Run the script after updating static/ or Pyodide. It only
+rebuilds copies whose source file has changed.
+"""
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip alone is enough
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+COMPRESSIBLE_EXTENSIONS = (
+    ".js", ".mjs", ".css", ".wasm", ".json", ".svg", ".html", ".txt", ".map", ".zip", ".data",
+)
+MIN_SIZE = 1024
+# A copy is kept only if it saves at least 5% of the size
+MAX_RATIO = 0.95
+
+
+def _gzip(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+def _encoders():
+    encoders = [(".gz", _gzip)]
+    if brotli is not None:
+        encoders.append((".br", _brotli))
+    return encoders
+
+
+def _is_fresh(target, source):
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def _write_atomically(target, data):
+    tmp = target + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def precompress_file(path, force=False):
+    """Build the compressed copies of one file. Return the number of files written."""
+    written = 0
+    data = None
+    for suffix, encode in _encoders():
+        target = path + suffix
+        if not force and _is_fresh(target, path):
+            continue
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        compressed = encode(data)
+        if len(compressed) > len(data) * MAX_RATIO:
+            # Already-compressed data: drop a stale copy so the original is served
+            if os.path.exists(target):
+                os.remove(target)
+            continue
+        _write_atomically(target, compressed)
+        written += 1
+    return written
+
+
+def precompress(root=STATIC_DIR, force=False):
+    files = written = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if not name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(directory, name)
+            if os.path.getsize(path) < MIN_SIZE:
+                continue
+            files += 1
+            written += precompress_file(path, force=force)
+    return files, written
+
+
+def main():
+    force = "--force" in sys.argv[1:]
+    if not os.path.isdir(STATIC_DIR):
+        print("[ERROR] static directory not found:", STATIC_DIR)
+        return 1
+    files, written = precompress(force=force)
+    encodings = "gzip + brotli" if brotli is not None else "gzip"
+    print(f"Precompressed ({encodings}): {files} file(s) checked, {written} copy(ies) written.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
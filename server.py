@@ -2,29 +2,57 @@
 Система тестирования ЕГЭ по информатике
 Главный файл сервера
 """
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file, flash, session
+from flask import (Flask, Response, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file,
+                   flash, session, stream_with_context)
 import os
 import uuid
+import functools
+import mimetypes
+import threading
+import time
 import socket
 import secrets
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from datetime import datetime, timezone
 
-from config import (HOST, PORT, DATA_DIR, IMAGES_DIR, ATTACHMENTS_DIR, STUDENT_UPLOADS_DIR, EXPORTS_DIR,
+from config import (HOST, PORT, DATA_DIR, STATIC_DIR, IMAGES_DIR, ATTACHMENTS_DIR, STUDENT_UPLOADS_DIR, EXPORTS_DIR,
                     MAX_IMAGE_SIZE, MAX_ATTACHMENT_SIZE, MAX_IMPORT_ZIP_SIZE,
                     MAX_STUDENT_UPLOAD_SIZE, ALLOWED_STUDENT_UPLOAD_EXTENSIONS,
-                    ALLOWED_IMAGE_EXTENSIONS, ALLOWED_ATTACHMENT_EXTENSIONS,
+                    ALLOWED_IMAGE_EXTENSIONS, ALLOWED_ATTACHMENT_EXTENSIONS, IMAGE_VARIANT_WIDTHS,
                     DEFAULT_ANSWER_COUNT, SPECIAL_ANSWER_FORMAT,
+                    SAVE_BATCH_MAX_ITEMS, SSE_KEEPALIVE_SECONDS, PRESENCE_TOUCH_FRESH_SECONDS,
                     SECRET_KEY, TEACHER_ALLOWED_IPS)
-from models import init_db, migrate_db, Task, Variant, GradeCriteria, TestSession, Student, Answer, ClassGroup
+from models import (init_db, begin_request_db, end_request_db, read_snapshot, WriteTimeout,
+                    Task, Variant, GradeCriteria, TestSession, Student, Answer, ClassGroup)
+import analytics
+import images
 
-app = Flask(__name__)
+# Статика отдаётся собственным маршрутом (см. serve_static): с учётом Accept-Encoding
+app = Flask(__name__, static_folder=None)
 app.secret_key = SECRET_KEY
 
+# Уменьшенные копии изображений хранятся в WebP (не во всех системах есть в mimetypes)
+mimetypes.add_type('image/webp', '.webp')
+# Без верного Content-Type браузер не компилирует Pyodide потоково (instantiateStreaming)
+mimetypes.add_type('application/wasm', '.wasm')
+mimetypes.add_type('text/javascript', '.mjs')
+
+
+@app.before_request
+def open_request_db():
+    begin_request_db()
+
+
+@app.teardown_request
+def close_request_db(error=None):
+    end_request_db()
+
 
 @app.after_request
 def add_no_store_headers(response):
-    if request.path.startswith('/test'):
+    # Неизменяемые файлы сохраняют свои заголовки кэширования
+    if request.path.startswith('/test') and not response.cache_control.immutable:
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
@@ -32,6 +60,14 @@ def add_no_store_headers(response):
 
 PYODIDE_DIR = os.path.join('static', 'pyodide')
 
+@app.errorhandler(WriteTimeout)
+def handle_write_timeout(error):
+    # Ответ не записан: клиент ученика оставит его в очереди и отправит снова
+    app.logger.warning('%s: %s', request.path, error)
+    if request.path.startswith('/test'):
+        return jsonify({'success': False, 'error': 'Сервер занят, ответ будет сохранён повторно'}), 503
+    return 'Сервер занят, повторите действие', 503
+
 @app.errorhandler(Exception)
 def handle_exception(error):
     from werkzeug.exceptions import HTTPException
@@ -56,7 +92,6 @@ def handle_exception(error):
 
 # Инициализация БД при запуске
 init_db()
-migrate_db()
 
 
 def to_local_dt(value, with_seconds=False):
@@ -89,6 +124,14 @@ def local_date_filter(value):
     local = to_local_dt(value, with_seconds=False)
     return local[:10] if local else ''
 
+def with_read_snapshot(view):
+    """Выполнить отчёт учителя на read-only снимке БД."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with read_snapshot():
+            return view(*args, **kwargs)
+    return wrapper
+
 def get_local_ip():
     """Получить локальный IP-адрес"""
     try:
@@ -128,6 +171,40 @@ def _calc_remaining_seconds(student, test_session):
     remaining = max(0, time_limit * 60 + extra_seconds - effective_elapsed)
     return int(remaining)
 
+# Метка запуска процесса: контекст из cookie, подписанный до перезапуска, перепроверяется по БД
+_EXAM_CONTEXT_EPOCH = secrets.token_hex(8)
+
+def _set_exam_context(student):
+    """Положить неизменяемые поля ученика в подписанную cookie сессии Flask."""
+    ctx = {
+        'student_id': student['id'],
+        'session_id': student['session_id'],
+        'variant_id': student['variant_id'],
+        'started_at': student.get('started_at'),
+        'version': f'{_EXAM_CONTEXT_EPOCH}:{Student.roster_version()}',
+    }
+    session['exam'] = ctx
+    return ctx
+
+def _exam_context():
+    """Контекст ученика из cookie без чтения таблицы students.
+
+    Поля контекста не меняются, пока ученик существует; удаление учеников
+    сдвигает Student.roster_version(), и тогда контекст перечитывается из БД.
+    """
+    student_id = session.get('student_id')
+    if not student_id:
+        return None
+    ctx = session.get('exam')
+    if (ctx and ctx.get('student_id') == student_id
+            and ctx.get('version') == f'{_EXAM_CONTEXT_EPOCH}:{Student.roster_version()}'):
+        return ctx
+    student = Student.get_by_id(student_id)
+    if not student:
+        session.pop('exam', None)
+        return None
+    return _set_exam_context(student)
+
 def generate_unique_filename(original_filename):
     """Генерирует уникальное имя файла"""
     ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
@@ -261,12 +338,13 @@ def is_pyodide_available():
     return get_pyodide_base_url() is not None
 
 def get_pyodide_base_url():
+    # Версия в пути: Pyodide сам строит URL файлов от indexURL, и их можно кэшировать навсегда
     direct = os.path.join(PYODIDE_DIR, 'pyodide.js')
     nested = os.path.join(PYODIDE_DIR, 'pyodide', 'pyodide.js')
     if os.path.exists(direct):
-        return '/static/pyodide/'
+        return f'/static/_v/{_static_version(direct)}/pyodide/'
     if os.path.exists(nested):
-        return '/static/pyodide/pyodide/'
+        return f'/static/_v/{_static_version(nested)}/pyodide/pyodide/'
     return None
 
 def _normalize_ip(value):
@@ -496,9 +574,7 @@ def tasks_bulk_action():
             task = Task.get_by_id(task_id)
             if not task:
                 continue
-            image_path = os.path.join(IMAGES_DIR, task['image_path'])
-            if os.path.exists(image_path):
-                os.remove(image_path)
+            images.delete(os.path.join(IMAGES_DIR, task['image_path']))
             if task.get('attachment_path'):
                 attachment_path = os.path.join(ATTACHMENTS_DIR, task['attachment_path'])
                 if os.path.exists(attachment_path):
@@ -567,6 +643,7 @@ def task_add():
         image_filename = generate_unique_filename(image.filename)
         image_path = os.path.join(IMAGES_DIR, image_filename)
         image.save(image_path)
+        image_meta = _ingest_image(image_filename)
         
         # Обработка прикреплённого файла (опционально)
         attachment_path = None
@@ -616,6 +693,7 @@ def task_add():
             answer_text=answer_text,
             task_scope=mode,
             class_id=class_id if mode == 'class' else None,
+            **image_meta,
         )
 
         if mode == 'class':
@@ -703,13 +781,12 @@ def task_edit(task_id):
                 flash(image_error or 'Необходимо загрузить PNG-изображение', 'error')
                 return redirect(url_for('task_edit', task_id=task_id))
             # Удаляем старое изображение
-            old_image_path = os.path.join(IMAGES_DIR, task['image_path'])
-            if os.path.exists(old_image_path):
-                os.remove(old_image_path)
+            images.delete(os.path.join(IMAGES_DIR, task['image_path']))
             
             image_filename = generate_unique_filename(image.filename)
             image.save(os.path.join(IMAGES_DIR, image_filename))
             updates['image_path'] = image_filename
+            updates.update(_ingest_image(image_filename))
         
         # Обработка прикреплённого файла
         if request.form.get('remove_attachment') == '1':
@@ -740,8 +817,10 @@ def task_edit(task_id):
                 updates['attachment_path'] = attachment_filename
                 updates['attachment_name'] = attachment_name
         
-        Task.update(task_id, **updates)
+        regraded = Task.update(task_id, **updates)
         flash('Задача успешно обновлена', 'success')
+        if regraded:
+            flash(f'Ключ ответа изменён: пересчитано результатов — {regraded}', 'success')
         if updates.get('task_scope') == 'class':
             return redirect(url_for('tasks_list', mode='class', class_id=updates.get('class_id')))
         return redirect(url_for('tasks_list', mode='ege', ege=updates.get('ege_number', task['ege_number'])))
@@ -762,9 +841,7 @@ def task_delete(task_id):
     task = Task.get_by_id(task_id)
     if task:
         # Удаляем файлы
-        image_path = os.path.join(IMAGES_DIR, task['image_path'])
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        images.delete(os.path.join(IMAGES_DIR, task['image_path']))
         if task['attachment_path']:
             attachment_path = os.path.join(ATTACHMENTS_DIR, task['attachment_path'])
             if os.path.exists(attachment_path):
@@ -843,6 +920,7 @@ def tasks_bulk_upload():
                 attachment_name=attachment_name,
                 task_scope='class' if mode == 'class' else 'ege',
                 class_id=class_id if mode == 'class' else None,
+                **_image_dimensions(image_path),
             )
             index += 1
             created += 1
@@ -878,6 +956,7 @@ def api_upload_image():
     image_filename = generate_unique_filename(image.filename)
     image_path = os.path.join(IMAGES_DIR, image_filename)
     image.save(image_path)
+    _ingest_image(image_filename)
     
     return jsonify({
         'success': True,
@@ -895,7 +974,7 @@ def api_delete_image():
     if filename:
         image_path = os.path.join(IMAGES_DIR, filename)
         if os.path.exists(image_path):
-            os.remove(image_path)
+            images.delete(image_path)
             return jsonify({'success': True})
     
     return jsonify({'error': 'Файл не найден'}), 404
@@ -905,12 +984,123 @@ def api_delete_image():
 @app.route('/images/<filename>')
 def serve_image(filename):
     """Отдача изображений"""
-    return send_from_directory(IMAGES_DIR, filename)
+    return _send_immutable(IMAGES_DIR, filename)
 
 @app.route('/attachments/<filename>')
 def serve_attachment(filename):
     """Отдача прикреплённых файлов"""
-    return send_from_directory(ATTACHMENTS_DIR, filename, as_attachment=True)
+    return _send_immutable(ATTACHMENTS_DIR, filename, as_attachment=True)
+
+@app.route('/images/w<int:width>/<filename>')
+def serve_image_variant(width, filename):
+    """Уменьшенная копия изображения; без Pillow — перенаправление на оригинал"""
+    if width not in IMAGE_VARIANT_WIDTHS:
+        return 'Not Found', 404
+    variant = images.variant_path(os.path.join(IMAGES_DIR, secure_filename(filename)), width)
+    if variant:
+        return _send_immutable(IMAGES_DIR, os.path.basename(variant))
+    # Временное перенаправление: иначе браузер навсегда закэширует оригинал под адресом копии
+    return redirect(url_for('serve_image', filename=filename))
+
+def _ingest_image(filename):
+    """Обработать сохранённое изображение задачи; вернуть поля размеров для Task."""
+    width, height = images.ingest(os.path.join(IMAGES_DIR, filename))
+    return {'image_width': width, 'image_height': height}
+
+def _image_dimensions(filename):
+    width, height = images.dimensions(os.path.join(IMAGES_DIR, filename))
+    return {'image_width': width, 'image_height': height}
+
+@app.template_global()
+def image_thumb_url(task):
+    """Миниатюра изображения задачи для списков учителя."""
+    if not task.get('image_path'):
+        return None
+    width = task.get('image_width')
+    if images.AVAILABLE and width and width > IMAGE_VARIANT_WIDTHS[0]:
+        return url_for('serve_image_variant', width=IMAGE_VARIANT_WIDTHS[0], filename=task['image_path'])
+    return url_for('serve_image', filename=task['image_path'])
+
+@app.template_global()
+def image_srcset(task):
+    """srcset из уменьшенных копий и оригинала ('' — если копий нет)."""
+    width = task.get('image_width')
+    if not images.AVAILABLE or not width:
+        return ''
+    candidates = [f"{url_for('serve_image_variant', width=w, filename=task['image_path'])} {w}w"
+                  for w in IMAGE_VARIANT_WIDTHS if w < width]
+    if not candidates:
+        return ''
+    candidates.append(f"{url_for('serve_image', filename=task['image_path'])} {width}w")
+    return ', '.join(candidates)
+
+# Файлы задач сохраняются под новыми уникальными именами и не меняются на месте
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def _send_immutable(directory, filename, **kwargs):
+    """Отдать неизменяемый файл: кэш на год, строгий ETag, 304 и Range (через Werkzeug)."""
+    response = send_from_directory(directory, filename, max_age=IMMUTABLE_MAX_AGE,
+                                   conditional=True, etag=True, **kwargs)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# ==================== СТАТИКА ====================
+
+# Предпочтительный порядок: brotli сжимает wasm и js заметно лучше gzip
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def _static_version(path):
+    return format(int(os.path.getmtime(path)), 'x')
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """url_for('static', ...) получает ?v=<mtime>, поэтому ответ можно кэшировать навсегда."""
+    if endpoint != 'static' or 'v' in values:
+        return
+    path = safe_join(STATIC_DIR, values.get('filename', ''))
+    if path and os.path.isfile(path):
+        values['v'] = _static_version(path)
+
+def _send_static(filename, immutable):
+    path = safe_join(STATIC_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return 'Not Found', 404
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    send_path, encoding = path, None
+    for name, suffix in STATIC_ENCODINGS:
+        candidate = path + suffix
+        if (request.accept_encodings[name] and os.path.isfile(candidate)
+                and os.path.getmtime(candidate) >= os.path.getmtime(path)):
+            send_path, encoding = candidate, name
+            break
+    response = send_file(send_path, mimetype=mimetype, conditional=True, etag=True,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        # Неверсионированный URL: кэш есть, но каждый раз с проверкой ETag
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/static/<path:filename>', endpoint='static')
+def serve_static(filename):
+    # Навсегда кэшируется только текущая версия: устаревший или чужой ?v= — с проверкой ETag
+    version = request.args.get('v')
+    path = safe_join(STATIC_DIR, filename)
+    immutable = bool(version) and path is not None and os.path.isfile(path) and version == _static_version(path)
+    return _send_static(filename, immutable=immutable)
+
+@app.route('/static/_v/<version>/<path:filename>')
+def serve_static_versioned(version, filename):
+    base_url = get_pyodide_base_url()
+    immutable = base_url is not None and f'/static/_v/{version}/{filename}'.startswith(base_url)
+    return _send_static(filename, immutable=immutable)
 
 
 # ==================== ЗАГРУЗКА ФАЙЛОВ УЧЕНИКОВ ====================
@@ -923,7 +1113,7 @@ def student_upload_answer_file():
     if not student_id:
         return jsonify({'error': 'Не авторизован'}), 401
 
-    student = Student.get_by_id(student_id)
+    student = _exam_context()
     if not student:
         return jsonify({'error': 'Ученик не найден'}), 401
 
@@ -938,9 +1128,7 @@ def student_upload_answer_file():
         return jsonify({'error': 'Не указан task_id'}), 400
 
     # Проверяем, что задача входит в вариант ученика
-    tasks = Variant.get_tasks(student['variant_id'])
-    task_ids_in_variant = {t['id'] for t in tasks}
-    if task_id not in task_ids_in_variant:
+    if task_id not in Variant.get_task_ids(student['variant_id']):
         return jsonify({'error': 'Задача не принадлежит вашему варианту'}), 403
 
     task = Task.get_by_id(task_id)
@@ -1030,6 +1218,8 @@ def api_tasks_count():
 def api_tasks_by_ege(ege_number):
     """API: задачи по номеру ЕГЭ"""
     tasks = Task.get_by_ege_number(ege_number)
+    for task in tasks:
+        task['thumb_url'] = image_thumb_url(task)
     return jsonify(tasks)
 
 # ==================== ВАРИАНТЫ ====================
@@ -1293,7 +1483,8 @@ def variant_edit(variant_id):
                 answer_1=answer_1,
                 answer_count=answer_count,
                 answer_2=answer_2 if answer_count == 2 else None,
-                answer_text=None
+                answer_text=None,
+                **_ingest_image(image_filename)
             )
             created_task_ids.append(new_task_id)
 
@@ -1414,6 +1605,7 @@ def variant_upload():
         image_filename = f"{uuid.uuid4().hex}{ext}"
         image_path = os.path.join(DATA_DIR, 'images', image_filename)
         image.save(image_path)
+        image_meta = _ingest_image(image_filename)
 
         # Обрабатываем прикреплённый файл (если есть)
         attachment_path = None
@@ -1447,6 +1639,7 @@ def variant_upload():
             attachment_name=attachment_name,
             answer_kind='file_upload' if is_file_upload else 'classic',
             task_scope=task_scope,
+            **image_meta,
         )
         task_ids.append(task_id)
     
@@ -1464,6 +1657,7 @@ def variant_upload():
 # ==================== ТЕСТИРОВАНИЯ ====================
 
 @app.route('/sessions')
+@with_read_snapshot
 def sessions_list():
     """Список тестирований"""
     status_filter = request.args.get('status', 'all')
@@ -1503,20 +1697,9 @@ def sessions_list():
         selected_session = next((s for s in filtered_sessions if s['id'] == selected_session_id), None)
 
     if selected_session:
-        selected_students = TestSession.get_students(selected_session['id'])
-        session_criteria = {
-            'grade_5_min': selected_session.get('grade_5_min'),
-            'grade_4_min': selected_session.get('grade_4_min'),
-            'grade_3_min': selected_session.get('grade_3_min')
-        }
+        selected_students = TestSession.get_students_with_scores(selected_session['id'])
         for st in selected_students:
-            if st['status'] == 'finished':
-                answers = Student.get_answers(st['id'])
-                tasks = Variant.get_tasks(st['variant_id'])
-                st['correct_count'] = len([a for a in answers if a['is_correct']])
-                st['total_tasks'] = len(tasks)
-                st['grade'] = GradeCriteria.calculate_grade(st['correct_count'], st['total_tasks'], session_criteria)
-            else:
+            if st['status'] != 'finished':
                 st['correct_count'] = 0
                 st['total_tasks'] = 0
                 st['grade'] = None
@@ -1535,6 +1718,7 @@ def sessions_list():
 def session_delete(session_id):
     """Удаление тестирования с результатами"""
     deleted = TestSession.delete_with_results(session_id)
+    _monitor_feed.forget(session_id)
     if deleted:
         flash('Тестирование удалено', 'success')
     else:
@@ -1560,6 +1744,7 @@ def session_delete_bulk():
     for session_id in session_ids:
         if TestSession.delete_with_results(session_id):
             deleted_count += 1
+        _monitor_feed.forget(session_id)
 
     flash(f'Удалено тестирований: {deleted_count}', 'success')
     return redirect(url_for('sessions_list', status=status, q=q))
@@ -1674,6 +1859,7 @@ def session_close(session_id):
     """Закрыть тестирование"""
     Student.finish_all(session_id)
     TestSession.close(session_id)
+    _monitor_feed.forget(session_id)
     flash('Тестирование завершено', 'success')
     return redirect(url_for('sessions_list'))
 
@@ -1718,21 +1904,140 @@ def session_monitor(session_id):
         flash('Тестирование не найдено', 'error')
         return redirect(url_for('sessions_list'))
     
-    students = TestSession.get_students(session_id)
-    now = datetime.now(timezone.utc).replace(tzinfo=None)
-    online_count = 0
-    for s in students:
-        last_seen = _parse_dt(s.get('last_seen_at'))
-        s['last_seen_at'] = last_seen.isoformat() if last_seen else None
-        s['is_online'] = bool(last_seen and (now - last_seen).total_seconds() <= 25)
-        if s['is_online']:
-            online_count += 1
-        s['file_uploads_count'] = Answer.count_uploads_for_student(s['id'])
+    students = _monitor_rows(session_id)
+    online_count = len([s for s in students if s['is_online']])
+    # Страница сразу получает курсор: дальше подгружаются только изменения
+    cursor, _, _, _ = _monitor_feed.changes(session_id, students, None, keep=session['status'] == 'active')
     
     return render_template('teacher/session_monitor.html',
                          session=session,
                          students=students,
-                         online_count=online_count)
+                         online_count=online_count,
+                         feed_cursor=cursor)
+
+@app.route('/sessions/<int:session_id>/monitor/feed')
+def session_monitor_feed(session_id):
+    """Изменения в таблице мониторинга после курсора (JSON), long-poll.
+
+    Без изменений ответ задерживается до MONITOR_FEED_WAIT_SECONDS: строки
+    перечитываются раз в MONITOR_FEED_RECHECK_SECONDS, а пауза, продление и
+    закрытие сессии будят ожидание сразу.
+    """
+    since = request.args.get('cursor')
+    deadline = time.monotonic() + MONITOR_FEED_WAIT_SECONDS
+    seq = TestSession.event_seq(session_id)
+    woken = False
+    while True:
+        session = TestSession.get_by_id(session_id)
+        if not session:
+            return jsonify({'error': 'Тестирование не найдено'}), 404
+
+        students = _monitor_rows(session_id)
+        active = session['status'] == 'active'
+        cursor, changed, removed, full = _monitor_feed.changes(session_id, students, since, keep=active)
+        remaining = deadline - time.monotonic()
+        if woken or changed or removed or full or not active or remaining <= 0:
+            break
+        # Пока ждём, закреплённое за запросом соединение возвращается в пул
+        end_request_db()
+        new_seq = TestSession.wait_event(session_id, seq, min(MONITOR_FEED_RECHECK_SECONDS, remaining))
+        begin_request_db()
+        woken = new_seq != seq
+    return jsonify({
+        'cursor': cursor,
+        'status': session['status'],
+        'paused': bool(session.get('paused')),
+        'students_count': len(students),
+        'online_count': len([s for s in students if s['is_online']]),
+        'students': changed,
+        'removed': removed,
+        'full': full,
+    })
+
+MONITOR_ONLINE_SECONDS = 25
+# Long-poll ленты мониторинга: сколько держать запрос без изменений и как часто перечитывать строки
+MONITOR_FEED_WAIT_SECONDS = 25
+MONITOR_FEED_RECHECK_SECONDS = 5
+
+def _monitor_rows(session_id):
+    """Строки таблицы мониторинга в том виде, в каком они показываются учителю."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = []
+    for s in TestSession.get_monitor_rows(session_id):
+        last_seen = _parse_dt(Student.get_last_seen(s['id']) or s.get('last_seen_at'))
+        rows.append({
+            'id': s['id'],
+            'first_name': s['first_name'],
+            'last_name': s['last_name'],
+            'status': s['status'],
+            'is_online': bool(last_seen and (now - last_seen).total_seconds() <= MONITOR_ONLINE_SECONDS),
+            'started_at': s['started_at'][11:16] if s.get('started_at') else None,
+            'finished_at': s['finished_at'][11:16] if s.get('finished_at') else None,
+            'last_seen_at': last_seen.isoformat()[11:16] if last_seen else None,
+            'answered_count': s['answered_count'],
+            'file_uploads_count': s['file_uploads_count'],
+            'result_url': url_for('result_student', student_id=s['id']),
+        })
+    return rows
+
+class MonitorFeed:
+    """Курсор изменений таблицы мониторинга.
+
+    Для каждой строки хранится её последнее содержимое и номер изменения;
+    клиент получает только строки, изменившиеся после его курсора, и id
+    удалённых учеников. Курсор включает метку процесса: после перезапуска,
+    как и после того, как состояние сессии забыто, сервер отдаёт полный список.
+    Состояние держится только для идущих сессий.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = secrets.token_hex(4)
+        self._seq = 0
+        self._rows = {}  # session_id -> {student_id: (row или None, если удалён, seq)}
+
+    def changes(self, session_id, rows, cursor, keep=True):
+        """(курсор, изменённые строки, id удалённых, полный ли список).
+
+        При полном списке клиент убирает строки, которых в нём нет.
+        keep=False — не хранить состояние сессии после ответа (сессия закрыта).
+        """
+        since = None
+        if cursor:
+            epoch, _, seq = str(cursor).partition(':')
+            if epoch == self._epoch and seq.isdigit():
+                since = int(seq)
+        with self._lock:
+            if session_id not in self._rows:
+                since = None
+            known = self._rows.setdefault(session_id, {})
+            present = {row['id'] for row in rows}
+            for student_id, (row, _) in list(known.items()):
+                if student_id not in present and row is not None:
+                    self._seq += 1
+                    known[student_id] = (None, self._seq)
+            for row in rows:
+                prev = known.get(row['id'])
+                if prev is None or prev[0] != row:
+                    self._seq += 1
+                    known[row['id']] = (row, self._seq)
+            if since is not None and since > self._seq:
+                since = None
+            full = since is None
+            if full:
+                changed, removed = list(rows), []
+            else:
+                changed = [row for row in rows if known[row['id']][1] > since]
+                removed = [sid for sid, (row, seq) in known.items() if row is None and seq > since]
+            if not keep:
+                del self._rows[session_id]
+            return f'{self._epoch}:{self._seq}', changed, removed, full
+
+    def forget(self, session_id):
+        with self._lock:
+            self._rows.pop(session_id, None)
+
+_monitor_feed = MonitorFeed()
 
 
 # ==================== ИНТЕРФЕЙС УЧЕНИКА ====================
@@ -1804,22 +2109,12 @@ def student_start():
     if active_session['individual_mode']:
         # Генерируем индивидуальный вариант
         import random
-        from models import get_db
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Получаем настройки сессии
-        cursor.execute("SELECT value FROM settings WHERE key = ?", 
-                      (f"session_{active_session['id']}_ege",))
-        ege_row = cursor.fetchone()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", 
-                      (f"session_{active_session['id']}_count",))
-        count_row = cursor.fetchone()
-        conn.close()
-        
-        ege_number = int(ege_row['value']) if ege_row else 0
-        tasks_count = int(count_row['value']) if count_row else 10
+        # Параметры индивидуального режима хранятся в самой сессии
+        ege_number = active_session.get('thematic_ege_number')
+        tasks_count = active_session.get('thematic_tasks_count')
+        ege_number = 0 if ege_number is None else ege_number
+        tasks_count = 10 if tasks_count is None else tasks_count
         
         # Создаём временный вариант
         variant_name = f"Индивидуальный_{first_name}_{last_name}_{active_session['id']}"
@@ -1869,6 +2164,7 @@ def student_test():
     if not student or student['status'] == 'finished':
         session.clear()
         return redirect(url_for('student_login'))
+    _set_exam_context(student)
 
     test_session = TestSession.get_by_id(student['session_id'])
     if test_session and test_session['status'] == 'closed':
@@ -1879,11 +2175,7 @@ def student_test():
     tasks = Variant.get_tasks(student['variant_id'])
     
     # Получаем уже сохранённые ответы
-    answers = {}
-    for task in tasks:
-        ans = Answer.get_for_student_task(student_id, task['id'])
-        if ans:
-            answers[task['id']] = ans
+    answers = Answer.get_for_student(student_id)
     
     # Вычисляем оставшееся время по данным БД (устойчиво к перезапуску браузера)
     remaining = _calc_remaining_seconds(student, test_session)
@@ -1894,13 +2186,21 @@ def student_test():
                           student=student,
                           tasks=tasks,
                           answers=answers,
+                          answer_revs={task_id: a['client_rev'] for task_id, a in answers.items()},
                           remaining=int(remaining),
                           current_task=current_task,
                           teacher_finish_only=bool(test_session and test_session.get('teacher_finish_only')),
                           app_mode=bool(session.get('app_mode')),
                           paused=bool(test_session and test_session.get('paused')),
                           calculator_enabled=bool(test_session and test_session.get('calculator_enabled')),
-                          python_enabled=bool(test_session and test_session.get('python_enabled')))
+                          python_enabled=bool(test_session and test_session.get('python_enabled')),
+                          save_batch_max=SAVE_BATCH_MAX_ITEMS)
+
+@app.route('/test/sw.js')
+def student_service_worker():
+    """Service worker страницы теста: лежит в /test/, чтобы управлять её областью."""
+    return send_from_directory(os.path.join(STATIC_DIR, 'js'), 'exam_sw.js',
+                               mimetype='text/javascript', max_age=0)
 
 @app.route('/test/save', methods=['POST'])
 def student_save_answer():
@@ -1913,20 +2213,96 @@ def student_save_answer():
     
     data = request.get_json()
     task_id = data.get('task_id')
+    answer_1, answer_2, answer_text = _clean_answer_fields(data)
+
+    rev = _client_rev(data)
+    saved = Answer.save(student_id, task_id, answer_1, answer_2, answer_text=answer_text, client_rev=rev)
+    Student.touch(student_id)
+    if saved is Answer.STALE:
+        # Ревизия устарела: сообщаем записанную, чтобы клиент не счёл чужой ответ своим
+        res = Answer.describe_stale(student_id, [(task_id, answer_1, answer_2, answer_text, rev)])[0]
+        return jsonify(_save_result(res))
+    
+    return jsonify({'success': True, 'rev': rev or 0})
+
+@app.route('/test/save-batch', methods=['POST'])
+def student_save_batch():
+    """Пакетное автосохранение: несколько ответов одной транзакцией"""
+    from flask import session
+    
+    student_id = session.get('student_id')
+    if not student_id:
+        return jsonify({'error': 'Не авторизован'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    raw_items = data.get('answers')
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify({'error': 'Нет ответов для сохранения'}), 400
+    if len(raw_items) > SAVE_BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Слишком много ответов за раз (максимум {SAVE_BATCH_MAX_ITEMS})'}), 400
+
+    # Повторы одной задачи схлопываем: сохраняется значение с наибольшей ревизией
+    # (без ревизий — последнее), и каждый повтор получает его результат. Повтор пакета
+    # из очереди клиента ничего не пишет: его ревизии уже записаны, и он отвечает
+    # успехом со stale. Результаты идут в порядке ответов запроса.
+    items = {}
+    slots = []
+    for raw in raw_items:
+        task_id = raw.get('task_id') if isinstance(raw, dict) else None
+        if isinstance(task_id, bool) or not isinstance(task_id, int):
+            slots.append({'task_id': task_id, 'success': False, 'error': 'Не указан task_id'})
+            continue
+        slots.append(task_id)
+        rev = _client_rev(raw)
+        previous = items.get(task_id)
+        if previous and rev and previous[4] and rev < previous[4]:
+            continue
+        items[task_id] = (task_id,) + _clean_answer_fields(raw) + (rev,)
+
+    saved = {res['task_id']: _save_result(res) for res in Answer.save_many(student_id, list(items.values()))}
+    results = [slot if isinstance(slot, dict) else saved[slot] for slot in slots]
+    Student.touch(student_id)
+    
+    return jsonify({'success': all(r['success'] for r in results), 'results': results})
+
+def _save_result(res):
+    """Результат Answer.save_many/describe_stale для ответа клиенту.
+
+    Повтор уже записанного ответа — успех со stale; другой ответ с более новой
+    ревизией (например, с другого компьютера) — конфликт: клиент оставляет ответ
+    несохранённым и следующую ревизию берёт больше записанной.
+    """
+    if 'error' in res:
+        return {'task_id': res['task_id'], 'success': False, 'error': res['error']}
+    if res.get('stale'):
+        result = {'task_id': res['task_id'], 'success': not res['conflict'], 'stale': True, 'rev': res['rev']}
+        if res['conflict']:
+            result.update(conflict=True, stored=res['stored'])
+        return result
+    return {'task_id': res['task_id'], 'success': True, 'rev': res['rev']}
+
+# Number.MAX_SAFE_INTEGER: больше клиент прислать не может, а в INTEGER SQLite помещается
+MAX_CLIENT_REV = 2 ** 53 - 1
+
+def _client_rev(data):
+    """Ревизия ответа от клиента (растёт с каждым изменением) или None."""
+    rev = data.get('rev')
+    if isinstance(rev, bool) or not isinstance(rev, int) or not 0 < rev <= MAX_CLIENT_REV:
+        return None
+    return rev
+
+def _clean_answer_fields(data):
+    """Поля ответа из JSON: (answer_1, answer_2, answer_text)."""
     answer_1 = data.get('answer_1')
     answer_2 = data.get('answer_2')
     answer_text = data.get('answer_text')
 
     # Разрешаем ответы не только числами: сохраняем как строки.
-    # Сравнение/нормализация делаются в Answer.save().
+    # Сравнение/нормализация делаются в Answer.check().
     answer_1 = (str(answer_1).strip() if answer_1 not in [None, ''] else None)
     answer_2 = (str(answer_2).strip() if answer_2 not in [None, ''] else None)
     answer_text = (str(answer_text) if answer_text not in [None] else None)
-
-    Answer.save(student_id, task_id, answer_1, answer_2, answer_text=answer_text)
-    Student.touch(student_id)
-    
-    return jsonify({'success': True})
+    return answer_1, answer_2, answer_text
 
 @app.route('/test/finish', methods=['POST'])
 def student_finish():
@@ -1958,23 +2334,86 @@ def student_ping():
     if not student_id:
         return jsonify({'active': False}), 401
 
-    student = Student.get_by_id(student_id)
-    if not student:
+    ctx = _exam_context()
+    state = _exam_state_for(ctx) if ctx else None
+    if not state:
         return jsonify({'active': False}), 404
 
-    test_session = TestSession.get_by_id(student['session_id'])
-    if not test_session:
-        return jsonify({'active': False}), 404
+    # Отметка присутствия — в памяти и только если устарела
+    Student.touch(student_id, PRESENCE_TOUCH_FRESH_SECONDS)
+    return jsonify(state)
 
-    Student.touch(student_id)
-    remaining = _calc_remaining_seconds(student, test_session)
+def _exam_state_for(ctx):
+    """Состояние тестирования по контексту ученика.
+
+    Пока сессия активна, хватает кэша сессий и полей контекста — таблица
+    students не читается. Закрытую или пропавшую сессию проверяем по БД.
+    """
+    test_session = TestSession.get_by_id(ctx['session_id'])
+    if test_session and test_session['status'] == 'active':
+        return {'active': True, 'paused': bool(test_session.get('paused')),
+                'remaining_seconds': _calc_remaining_seconds(ctx, test_session)}
+    state = Student.get_exam_state(ctx['student_id'])
+    return _exam_state(state) if state else None
+
+def _exam_state(state):
+    """Состояние тестирования для ученика по строке Student.get_exam_state()."""
+    if state['session_status'] == 'closed':
+        if state['student_status'] != 'finished':
+            Student.finish(state['id'])
+        return {'active': False, 'finished': True, 'redirect': url_for('student_result')}
+
+    # Тот же расчёт, что и в _calc_remaining_seconds, но по заранее посчитанному сроку
+    now = time.time()
+    limit = state['time_limit'] * 60 + (state['extra_seconds'] or 0)
+    if state['deadline_ts'] is None:
+        # Время начала не записано — отсчёт ещё не шёл, доступно всё время
+        remaining = limit
+    else:
+        remaining = state['deadline_ts'] - now
+        if state['paused'] and state['paused_at_ts'] is not None:
+            remaining += now - state['paused_at_ts']
+    remaining = int(max(0, min(limit, remaining)))
+    return {'active': True, 'paused': bool(state['paused']), 'remaining_seconds': remaining}
+
+@app.route('/test/events')
+def student_events():
+    """Поток SSE: пауза, продление и закрытие тестирования приходят сразу"""
+    import json
+
+    student_id = session.get('student_id')
+    if not student_id:
+        return jsonify({'active': False}), 401
+
+    ctx = _exam_context()
+    if not ctx:
+        return jsonify({'active': False}), 404
+    session_id = ctx['session_id']
 
-    if test_session['status'] == 'closed':
-        if student['status'] != 'finished':
-            Student.finish(student_id)
-        return jsonify({'active': False, 'finished': True, 'redirect': url_for('student_result')})
+    # Поток живёт долго — не держим закреплённое за запросом соединение
+    end_request_db()
 
-    return jsonify({'active': True, 'paused': bool(test_session.get('paused')), 'remaining_seconds': remaining})
+    @stream_with_context
+    def _stream():
+        seq = TestSession.event_seq(session_id)
+        Student.touch(student_id)
+        # Клиент переподключается через 3 с, если соединение оборвалось
+        yield 'retry: 3000\n\n'
+        while True:
+            state = _exam_state_for(ctx) or {'active': False}
+            yield f"event: state\ndata: {json.dumps(state)}\n\n"
+            if not state['active']:
+                return
+            while True:
+                new_seq = TestSession.wait_event(session_id, seq, SSE_KEEPALIVE_SECONDS)
+                Student.touch(student_id)
+                if new_seq != seq:
+                    seq = new_seq
+                    break
+                yield ': keepalive\n\n'
+
+    return Response(_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/test/run-python', methods=['POST'])
 def student_run_python():
@@ -2245,12 +2684,10 @@ def student_result():
         Student.finish(student_id)
     
     # Получаем все ответы
-    answers = Student.get_answers(student_id)
+    answers_dict = Answer.get_for_student(student_id)
+    answers = list(answers_dict.values())
     tasks = Variant.get_tasks(student['variant_id'])
     
-    # Создаём словарь ответов по task_id
-    answers_dict = {a['task_id']: a for a in answers}
-    
     correct_count = len([a for a in answers if a['is_correct']])
     total = len(tasks)
     
@@ -2281,6 +2718,7 @@ def student_result():
 # ==================== РЕЗУЛЬТАТЫ ====================
 
 @app.route('/results')
+@with_read_snapshot
 def results_list():
     """Список результатов по тестированиям"""
     from datetime import datetime, timedelta
@@ -2338,22 +2776,12 @@ def results_list():
         selected_session = next((s for s in filtered_sessions if s['id'] == selected_session_id), None)
 
     if selected_session:
-        selected_students = TestSession.get_students(selected_session['id'])
-        session_criteria = {
-            'grade_5_min': selected_session.get('grade_5_min'),
-            'grade_4_min': selected_session.get('grade_4_min'),
-            'grade_3_min': selected_session.get('grade_3_min')
-        }
+        selected_students = TestSession.get_students_with_scores(selected_session['id'])
 
         total_correct_all = 0
         finished_for_avg = 0
         for st in selected_students:
             if st['status'] == 'finished':
-                answers = Student.get_answers(st['id'])
-                tasks = Variant.get_tasks(st['variant_id'])
-                st['correct_count'] = len([a for a in answers if a['is_correct']])
-                st['total_tasks'] = len(tasks)
-                st['grade'] = GradeCriteria.calculate_grade(st['correct_count'], st['total_tasks'], session_criteria)
                 total_correct_all += st['correct_count']
                 finished_for_avg += 1
             else:
@@ -2375,6 +2803,7 @@ def results_list():
     )
 
 @app.route('/results/session/<int:session_id>')
+@with_read_snapshot
 def result_session(session_id):
     """Результаты по конкретному тестированию"""
     session = TestSession.get_by_id(session_id)
@@ -2382,26 +2811,38 @@ def result_session(session_id):
         flash('Тестирование не найдено', 'error')
         return redirect(url_for('results_list'))
     
-    students = TestSession.get_students(session_id)
-    
-    # Критерии оценки для этой сессии
-    session_criteria = {
-        'grade_5_min': session.get('grade_5_min'),
-        'grade_4_min': session.get('grade_4_min'),
-        'grade_3_min': session.get('grade_3_min')
-    }
-    
-    # Добавляем результаты каждого ученика
+    # Итоги учеников поддерживаются в student_scores при каждой записи ответов
+    students = TestSession.get_students_with_scores(session_id)
     for st in students:
-        answers = Student.get_answers(st['id'])
-        tasks = Variant.get_tasks(st['variant_id'])
-        st['correct'] = len([a for a in answers if a['is_correct']])
-        st['total'] = len(tasks)
-        st['grade'] = GradeCriteria.calculate_grade(st['correct'], st['total'], session_criteria)
+        st['correct'] = st['correct_count']
+        st['total'] = st['total_tasks']
     
     return render_template('teacher/result_session.html', session=session, students=students)
 
+@app.route('/results/session/<int:session_id>/analytics')
+def result_session_analytics(session_id):
+    """Анализ заданий тестирования (JSON): трудность, дискриминативность, решаемость"""
+    if not analytics.AVAILABLE:
+        return jsonify({'error': 'Для анализа заданий установите пакет numpy (pip install numpy)'}), 503
+    # Без with_read_snapshot: внутри снимка кэш анализа закрытых сессий не работает,
+    # а сам анализ читает из снимка
+    result = TestSession.get_item_analysis(session_id)
+    if result is None:
+        return jsonify({'error': 'Тестирование не найдено'}), 404
+    return jsonify(result)
+
+@app.route('/results/session/<int:session_id>/regrade', methods=['POST'])
+def result_session_regrade(session_id):
+    """Перепроверить ответы сессии по текущим ключам задач"""
+    if not TestSession.get_by_id(session_id):
+        flash('Тестирование не найдено', 'error')
+        return redirect(url_for('results_list'))
+    stats = Answer.regrade(session_id=session_id)
+    flash(f"Проверено ответов: {stats['checked']}, изменилось результатов: {stats['changed']}", 'success')
+    return redirect(url_for('result_session', session_id=session_id))
+
 @app.route('/results/student/<int:student_id>')
+@with_read_snapshot
 def result_student(student_id):
     """Детальный результат ученика"""
     student = Student.get_by_id(student_id)
@@ -2410,12 +2851,10 @@ def result_student(student_id):
         return redirect(url_for('results_list'))
     
     test_session = TestSession.get_by_id(student['session_id'])
-    answers = Student.get_answers(student_id)
+    answers_dict = Answer.get_for_student(student_id)
+    answers = list(answers_dict.values())
     tasks = Variant.get_tasks(student['variant_id'])
     
-    # Создаём словарь ответов по task_id
-    answers_dict = {a['task_id']: a for a in answers}
-    
     correct_count = len([a for a in answers if a['is_correct']])
     total = len(tasks)
     
@@ -2437,6 +2876,7 @@ def result_student(student_id):
                          grade=grade)
 
 @app.route('/results/export/<int:session_id>')
+@with_read_snapshot
 def result_export(session_id):
     """Экспорт результатов в CSV"""
     import csv
@@ -2448,7 +2888,7 @@ def result_export(session_id):
         flash('Тестирование не найдено', 'error')
         return redirect(url_for('results_list'))
     
-    students = TestSession.get_students(session_id)
+    students = TestSession.get_students_with_scores(session_id)
     
     # Создаём CSV
     output = StringIO()
@@ -2458,11 +2898,9 @@ def result_export(session_id):
     writer.writerow(['Фамилия', 'Имя', 'Начало', 'Завершение', 'Правильных', 'Всего', 'Оценка'])
     
     for st in students:
-        answers = Student.get_answers(st['id'])
-        tasks = Variant.get_tasks(st['variant_id'])
-        correct = len([a for a in answers if a['is_correct']])
-        total = len(tasks)
-        grade = GradeCriteria.calculate_grade(correct, total)
+        correct = st['correct_count']
+        total = st['total_tasks']
+        grade = st['grade']
         
         writer.writerow([
             st['last_name'],
@@ -2492,6 +2930,7 @@ def result_delete(session_id):
         return redirect(url_for('results_list'))
 
     deleted = TestSession.delete_with_results(session_id)
+    _monitor_feed.forget(session_id)
     if deleted:
         flash('Результаты тестирования удалены', 'success')
     else:
@@ -2517,6 +2956,7 @@ def result_delete_bulk():
     for session_id in session_ids:
         if TestSession.delete_with_results(session_id):
             deleted_count += 1
+        _monitor_feed.forget(session_id)
 
     if deleted_count:
         flash(f'Удалено тестирований: {deleted_count}', 'success')
@@ -2691,6 +3131,7 @@ def tasks_import():
                     
                     with open(image_save_path, 'wb') as f:
                         f.write(image_content)
+                    image_meta = _ingest_image(image_filename)
                     
                     # Обрабатываем прикреплённый файл
                     attachment_path = None
@@ -2725,7 +3166,8 @@ def tasks_import():
                         answer_2=task_data.get('answer_2'),
                         answer_text=task_data.get('answer_text'),
                         attachment_path=attachment_path,
-                        attachment_name=attachment_name
+                        attachment_name=attachment_name,
+                        **image_meta
                     )
                     imported_count += 1
                 
@@ -27,6 +27,16 @@ if errorlevel 1 (
     pip install -r requirements.txt
 )
 
+:: Pillow (сжатие и уменьшенные копии картинок задач) мог не стоять в старых установках
+pip show pillow >nul 2>&1
+if errorlevel 1 (
+    echo Установка Pillow...
+    pip install -r requirements.txt
+)
+
+:: Сжатые копии статики (пересобираются только изменившиеся файлы)
+python scripts\precompress_static.py
+
 echo.
 echo Запуск сервера...
 echo Для остановки закройте это окно или нажмите Ctrl+C
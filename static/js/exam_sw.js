@@ -0,0 +1,97 @@
+// Service worker страницы тестирования (отдаётся как /test/sw.js, область — /test/).
+// Держит в кэше картинки и файлы задач варианта и последнюю копию страницы теста,
+// чтобы кратковременный обрыв Wi-Fi не приводил к пустым картинкам и перезагрузкам.
+const CACHE = 'exam-files-v1';
+// Путь страницы теста хранится в самом кэше: воркер может быть остановлен в любой момент
+const EXAM_PAGE_KEY = '/test/__exam_page__';
+
+self.addEventListener('install', () => self.skipWaiting());
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names.filter((n) => n.startsWith('exam-files-') && n !== CACHE).map((n) => caches.delete(n)));
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('message', (event) => {
+    const msg = event.data || {};
+    if (msg.type === 'precache') {
+        event.waitUntil(precache(msg.urls || [], msg.page));
+    }
+});
+
+async function precache(urls, page) {
+    const cache = await caches.open(CACHE);
+    if (page) await cache.put(EXAM_PAGE_KEY, new Response(page));
+    await Promise.all(urls.map(async (url) => {
+        if (await cache.match(url)) return;
+        try {
+            const response = await fetch(url, { credentials: 'same-origin' });
+            if (response.ok) await cache.put(url, response);
+        } catch (e) {
+            // нет сети — докачается при следующем запросе
+        }
+    }));
+}
+
+// Кэшируются только неизменяемые URL: файлы задач и версионированная статика
+function isTaskFile(url) {
+    if (url.origin !== self.location.origin) return false;
+    if (url.pathname.startsWith('/images/') || url.pathname.startsWith('/attachments/')) return true;
+    return url.pathname.startsWith('/static/_v/') ||
+        (url.pathname.startsWith('/static/') && url.searchParams.has('v'));
+}
+
+// Уменьшенная копия /images/w<ширина>/<имя> без сети заменяется закэшированным оригиналом
+function originalImageUrl(url) {
+    const m = url.pathname.match(/^\/images\/w\d+\/([^/]+)$/);
+    return m ? new URL('/images/' + m[1], url.origin).href : null;
+}
+
+// Картинки и файлы задач не меняются под тем же именем — сначала кэш
+async function cacheFirst(request) {
+    const cache = await caches.open(CACHE);
+    const cached = await cache.match(request, { ignoreVary: true });
+    if (cached) return cached;
+    try {
+        const response = await fetch(request);
+        if (response.ok && response.status === 200) cache.put(request, response.clone());
+        return response;
+    } catch (e) {
+        const original = originalImageUrl(new URL(request.url));
+        const fallback = original && await cache.match(original);
+        if (fallback) return fallback;
+        throw e;
+    }
+}
+
+// Страница теста — всегда из сети; копия из кэша только если сети нет
+async function examPage(request) {
+    const cache = await caches.open(CACHE);
+    try {
+        const response = await fetch(request);
+        if (response.ok && !response.redirected) cache.put(request.url.split('?')[0], response.clone());
+        return response;
+    } catch (e) {
+        const cached = await cache.match(request, { ignoreSearch: true });
+        if (cached) return cached;
+        throw e;
+    }
+}
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (request.mode === 'navigate') {
+        event.respondWith((async () => {
+            const cache = await caches.open(CACHE);
+            const marker = await cache.match(EXAM_PAGE_KEY);
+            const page = marker ? await marker.text() : null;
+            return page === url.pathname ? examPage(request) : fetch(request);
+        })());
+        return;
+    }
+    if (isTaskFile(url)) event.respondWith(cacheFirst(request));
+});
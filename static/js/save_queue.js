@@ -0,0 +1,80 @@
+// Очередь неотправленных ответов ученика в IndexedDB.
+// Записи отправляются строго по порядку добавления и удаляются только после ответа сервера,
+// поэтому обрыв Wi-Fi или перезагрузка страницы не теряют введённое.
+(function () {
+    const DB_NAME = 'exam-save-queue';
+    const STORE = 'saves';
+
+    function openDb() {
+        return new Promise((resolve, reject) => {
+            const req = indexedDB.open(DB_NAME, 1);
+            req.onupgradeneeded = () => {
+                const store = req.result.createObjectStore(STORE, { keyPath: 'seq', autoIncrement: true });
+                store.createIndex('student', 'student_id');
+            };
+            req.onsuccess = () => resolve(req.result);
+            req.onerror = () => reject(req.error);
+        });
+    }
+
+    function done(tx) {
+        return new Promise((resolve, reject) => {
+            tx.oncomplete = () => resolve();
+            tx.onerror = tx.onabort = () => reject(tx.error);
+        });
+    }
+
+    // Без IndexedDB (приватный режим, старый браузер) очередь живёт только в памяти вкладки
+    function memoryQueue(studentId) {
+        let items = [];
+        let seq = 0;
+        return {
+            persistent: false,
+            async push(entries) {
+                entries.forEach((e) => items.push(Object.assign({ seq: ++seq, student_id: studentId }, e)));
+            },
+            async list() { return items.slice(); },
+            async remove(seqs) {
+                const drop = new Set(seqs);
+                items = items.filter((e) => !drop.has(e.seq));
+            }
+        };
+    }
+
+    function idbQueue(db, studentId) {
+        return {
+            persistent: true,
+            async push(entries) {
+                const tx = db.transaction(STORE, 'readwrite');
+                const store = tx.objectStore(STORE);
+                entries.forEach((e) => store.add(Object.assign({ student_id: studentId }, e)));
+                await done(tx);
+            },
+            list() {
+                return new Promise((resolve, reject) => {
+                    const tx = db.transaction(STORE, 'readonly');
+                    const req = tx.objectStore(STORE).index('student').getAll(IDBKeyRange.only(studentId));
+                    req.onsuccess = () => resolve(req.result.sort((a, b) => a.seq - b.seq));
+                    req.onerror = () => reject(req.error);
+                });
+            },
+            async remove(seqs) {
+                if (!seqs.length) return;
+                const tx = db.transaction(STORE, 'readwrite');
+                const store = tx.objectStore(STORE);
+                seqs.forEach((seq) => store.delete(seq));
+                await done(tx);
+            }
+        };
+    }
+
+    window.openSaveQueue = async function (studentId) {
+        if (!window.indexedDB) return memoryQueue(studentId);
+        try {
+            return idbQueue(await openDb(), studentId);
+        } catch (e) {
+            console.warn('IndexedDB недоступна, очередь ответов только в памяти:', e);
+            return memoryQueue(studentId);
+        }
+    };
+})();